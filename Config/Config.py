@@ -6,12 +6,21 @@
 
 from __future__ import print_function
 
-import argparse
-from argparse import RawDescriptionHelpFormatter
+# Only modules needed by everything are imported here. Modules which are
+# only used by some commands (i.e. serial, which only the commands that talk
+# to a TinyG need) are imported when they're used, so that the offline
+# commands, and programs which import this module, start quickly.
+from array import array
+import collections
+import itertools
 import json
-import re
-import serial
+import os
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import sys
+import threading
 import time
 
 CONFIG_STR = {
@@ -151,6 +160,58 @@ CONFIG_READ_ONLY = { "sys" : { 'fb', 'fv', 'hp', 'hv', 'id', 'baud' }}
 
 AXIS_MODE = ['[disabled]', '[standard]', '[inhibited]', '[radius]']
 
+# Size of the TinyG serial receive buffer. When pipelining requests we never
+# allow more than this many bytes to be outstanding (i.e. sent but not yet
+# responded to), otherwise the TinyG would start dropping characters.
+RX_BUFFER_SIZE = 254
+
+# Maximum length of a line which TinyG will accept (including the newline).
+MAX_LINE_LEN = 254
+
+# Configurations cached by the show and dump commands are discarded once
+# they're older than CACHE_MAX_AGE seconds, and only the CACHE_MAX_ENTRIES
+# most recently used boards are kept.
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
+CACHE_MAX_ENTRIES = 64
+
+# A numeric value is reported as an outlier by the compare command when its
+# modified z-score (based on the median absolute deviation) exceeds this.
+OUTLIER_THRESHOLD = 3.5
+
+# Number of reports kept in memory by the monitor command, and how often
+# (in reports and in seconds) the recorded reports are written to the file.
+TELEMETRY_RING_SIZE = 1000
+TELEMETRY_FLUSH_COUNT = 100
+TELEMETRY_FLUSH_INTERVAL = 1.0
+
+# When streaming gcode, sending stops while the TinyG reports (using queue
+# reports) that fewer than this many planner buffers are free.
+PLANNER_LOW_WATER = 4
+
+# Seconds to wait for the response to a line of gcode. The TinyG doesn't
+# respond to a line until there's room for it in the planner, which may
+# take as long as the moves ahead of it take to run.
+STREAM_RESPONSE_TIMEOUT = 60
+
+# Status code in the footer of a response to a line which TinyG accepted.
+STAT_OK = 0
+
+# Number of times that a command which wasn't acknowledged is resent
+# during a restore, before the restore is abandoned.
+WRITE_RETRIES = 2
+
+# Number of configuration files given to each process at a time by the lint
+# command.
+LINT_CHUNK_SIZE = 4
+
+# Number of times that a query which wasn't answered is resent by a
+# sequential read, before the group is given up on.
+READ_RETRIES = 2
+
+# Number of times that a pipelined request will be resent after its
+# response was lost, before we give up on it.
+PIPELINE_RETRIES = 2
+
 def is_number(s):
     """Determines if a string looks like a number or not."""
     try:
@@ -171,32 +232,329 @@ def get_val(val_str):
         except ValueError:
             return val_str
 
+def to_json(obj):
+    """Serializes 'obj' in the compact form which is sent to the TinyG."""
+    return json.dumps(obj, separators=(',', ':'))
+
+def pack_commands(config, combine_groups=False):
+    """Breaks the writable items in 'config' up into a list of command
+       dictionaries, each of which serializes to a line which fits within
+       MAX_LINE_LEN. Each command is filled with as many items as will fit.
+       If 'combine_groups' is True, then items from several groups may
+       share a single command, otherwise each command contains a single group.
+    """
+    cmds = []
+    cmd = {}
+    num_items = 0
+    for mapEntry in CONFIG_MAP:
+        group_id = mapEntry[0]
+        group_config = config.get_group(group_id)
+        if not group_config:
+            continue
+        read_only = CONFIG_READ_ONLY.get(group_id, ())
+        if cmd and not combine_groups:
+            cmds.append(cmd)
+            cmd = {}
+            num_items = 0
+        for key in sorted(group_config):
+            if key in read_only:
+                continue
+            cmd.setdefault(group_id, {})[key] = group_config[key]
+            num_items += 1
+            # Allow for the newline which terminates the line. An item which
+            # is too long on its own is still sent by itself.
+            if len(to_json(cmd)) + 1 > MAX_LINE_LEN and num_items > 1:
+                # Doesn't fit - remove the item and start a new command
+                del cmd[group_id][key]
+                if not cmd[group_id]:
+                    del cmd[group_id]
+                cmds.append(cmd)
+                cmd = {group_id : {key : group_config[key]}}
+                num_items = 1
+    if cmd:
+        cmds.append(cmd)
+    return cmds
+
+def response_matches(cmd, response):
+    """Determines whether 'response' (the 'r' part of a response from the
+       TinyG) could be the response to the command dictionary 'cmd'. The
+       TinyG echoes back the names (and for a group, the keys) which were
+       sent, which lets a late response to an earlier command be told apart
+       from the response to 'cmd'.
+    """
+    if not isinstance(response, dict) or not response:
+        return False
+    for name, val in response.items():
+        if name not in cmd:
+            return False
+        if isinstance(cmd[name], dict) and isinstance(val, dict) and \
+                not set(val) <= set(cmd[name]):
+            return False
+    return True
+
+def values_equal(val1, val2):
+    """Compares two configuration values. TinyG stores its values as
+       single precision floats, so numbers are compared with a small
+       relative tolerance rather than exactly.
+    """
+    if isinstance(val1, (int, float)) and isinstance(val2, (int, float)):
+        return abs(val1 - val2) <= 1e-5 * max(1.0, abs(val1), abs(val2))
+    return val1 == val2
+
+def build_group_strs():
+    """Builds a dictionary which maps each group_id from CONFIG_MAP onto
+       the CONFIG_STR entries which describe it.
+    """
+    return {mapEntry[0] : CONFIG_STR[mapEntry[1]] for mapEntry in CONFIG_MAP}
+
+def build_key_index():
+    """Builds a dictionary which maps the ids used in TinyG's text output
+       (i.e. 'fb', 'xvm', 'g54x') onto a (group_id, key, format) tuple.
+    """
+    index = {}
+    for mapEntry in CONFIG_MAP:
+        group_id = mapEntry[0]
+        if group_id == 'sys':
+            continue
+        for strEntry in CONFIG_STR[mapEntry[1]]:
+            index[group_id + strEntry[0]] = (group_id, strEntry[0], strEntry[2])
+    # Ids from the sys group are added last, so that they take precedence.
+    for strEntry in CONFIG_STR['sys']:
+        index[strEntry[0]] = ('sys', strEntry[0], strEntry[2])
+    return index
+
+def build_render_plans():
+    """Builds the layout used by Config.format_text. Returns a list (in
+       CONFIG_MAP order) of (group_id, plan) tuples, where plan is a tuple of
+       (key, left, units) tuples. left is the id and description part of the
+       line (which doesn't depend on the value), and units is the format
+       string for the value.
+    """
+    plans = []
+    for mapEntry in CONFIG_MAP:
+        prefix = mapEntry[0]
+        mapPrefix = mapEntry[1]
+        plan = []
+        for strEntry in CONFIG_STR[mapPrefix]:
+            key = strEntry[0]
+            descr = strEntry[1]
+            if mapPrefix == '1':
+                descr = 'm{:s} {:s}'.format(prefix, descr)
+            elif mapPrefix in 'xagh':
+                descr = '{:s} {:s}'.format(prefix, descr)
+            if prefix == 'sys':
+                fmt_key = '[' + key + ']'
+            else:
+                fmt_key = '[' + prefix + key + ']'
+            left = '{:5s} {:29s}'.format(fmt_key, descr)[:35]
+            plan.append((key, left, strEntry[2]))
+        plans.append((prefix, tuple(plan)))
+    return plans
+
+def render_line(left, units, key, val):
+    """Formats a single line of $$ style output. The value is positioned so
+       that its decimal point (or the end of an integer) lines up.
+    """
+    if key == "am":
+        units = '{{:d}} {:s}'.format(AXIS_MODE[val])
+    right = units.format(val)
+    space = right.find(' ')
+    period = right.find('.')
+    align = space
+    if period > 0 and ((space < 0) or (space > 0 and period < space)):
+        align = period
+    if align < 0:
+        align = 1
+    return left[:-(align + 1)] + ' ' + right
+
+def build_slot_index():
+    """Assigns a slot number to each (group_id, key) described by CONFIG_STR,
+       for use by CompactConfig. Returns a (slots, num_slots) tuple, where
+       slots maps each group_id onto a dictionary of key to slot number.
+    """
+    slots = {}
+    num_slots = 0
+    for mapEntry in CONFIG_MAP:
+        group_slots = {}
+        for strEntry in CONFIG_STR[mapEntry[1]]:
+            group_slots[strEntry[0]] = num_slots
+            num_slots += 1
+        slots[mapEntry[0]] = group_slots
+    return (slots, num_slots)
+
+def parse_choices(key, fmt):
+    """Works out the values allowed for an item from the bracketed part of
+       its format string. Returns a set of values, a (low, high) tuple for a
+       range, or None if any value is allowed.
+    """
+    if key == 'am':
+        return (0, len(AXIS_MODE) - 1)
+    start = fmt.find('[')
+    end = fmt.find(']', start)
+    if start < 0 or end < 0:
+        return None
+    text = fmt[start + 1:end]
+    try:
+        if text.endswith('...'):
+            # An open ended list (i.e. [0=X,1=Y,2=Z...])
+            return None
+        if '..' in text:
+            # A range of numbers (i.e. [0..1])
+            (low, high) = text.split('..')
+            return (float(low), float(high))
+        first = text.split()[0]
+        if '-' in first:
+            # A range of integers (i.e. [1-6 (G54-G59)])
+            (low, high) = first.split('-')
+            return (int(low), int(high))
+        # A list of values (i.e. [1,2,4,8] or [0=off,1=on])
+        return frozenset(int(item.split('=')[0]) for item in text.split(','))
+    except ValueError:
+        return None
+
+def build_validators():
+    """Builds the rules used by Config.validate. Returns a dictionary which
+       maps each group_id onto a dictionary of key to (kind, choices), where
+       kind is the type which the value's format needs (int, float, or str)
+       and choices is from parse_choices.
+    """
+    validators = {}
+    for mapEntry in CONFIG_MAP:
+        group_rules = {}
+        for strEntry in CONFIG_STR[mapEntry[1]]:
+            fmt = strEntry[2]
+            if fmt.startswith('{:d}'):
+                kind = int
+            elif fmt.startswith('{:.'):
+                kind = float
+            else:
+                kind = str
+            group_rules[strEntry[0]] = (kind, parse_choices(strEntry[0], fmt))
+        validators[mapEntry[0]] = group_rules
+    return validators
+
+def check_value(val, kind, choices):
+    """Checks a single value against the rules from build_validators.
+       Returns a description of the problem, or None if the value is ok.
+    """
+    if kind is int:
+        if not isinstance(val, int) or isinstance(val, bool):
+            return "should be an integer, not %s" % json.dumps(val)
+    elif kind is float:
+        if not isinstance(val, (int, float)) or isinstance(val, bool):
+            return "should be a number, not %s" % json.dumps(val)
+    elif not isinstance(val, (str, type(u''))):
+        return "should be a string, not %s" % json.dumps(val)
+    if isinstance(choices, tuple):
+        if not choices[0] <= val <= choices[1]:
+            return "%s isn't in the range %s to %s" % (val, choices[0], choices[1])
+    elif choices is not None and val not in choices:
+        return "%s isn't one of %s" % (val, ', '.join(str(choice) for choice in sorted(choices)))
+    return None
+
+GROUP_STRS = build_group_strs()
+KEY_INDEX = build_key_index()
+RENDER_PLANS = build_render_plans()
+(SLOT_INDEX, NUM_SLOTS) = build_slot_index()
+VALIDATORS = build_validators()
+
+# Types of the values stored in a CompactConfig slot.
+SLOT_EMPTY = 0
+SLOT_INT = 1
+SLOT_FLOAT = 2
+
 def get_group_strs(group_id):
     """Returns the group strings for the indicated group_id."""
-    for mapEntry in CONFIG_MAP:
-        if mapEntry[0] == group_id:
-            return CONFIG_STR[mapEntry[1]]
+    return GROUP_STRS.get(group_id)
 
 def is_id_in_group(id, group_id):
-    """Scans the indicated group array, and returns True if the id is
-       found, False, otherwise."""
-    group_strs = get_group_strs(group_id)
-    for entry in group_strs:
-        if entry[0] == id:
-            return True
-    return False
+    """Returns True if the id is found in the indicated group, False
+       otherwise.
+    """
+    if group_id == 'sys':
+        entry = KEY_INDEX.get(id)
+    else:
+        entry = KEY_INDEX.get(group_id + id)
+    return entry is not None and entry[0] == group_id
 
 def id_to_group_key(id):
     """Converts a key from the text output into a (group, key) tuple."""
-    # Check to see if the ey exists in the sys group
-    if is_id_in_group(id, 'sys'):
-        return ('sys', id)
-    for mapEntry in CONFIG_MAP:
-        group_id = mapEntry[0]
-        if id.startswith(group_id):
-            group_key = id[len(group_id):]
-            if is_id_in_group(group_key, group_id):
-                return (group_id, group_key)
+    entry = KEY_INDEX.get(id)
+    if entry:
+        return entry[:2]
+
+
+def parse_text_line(line):
+    """Parses a single line of the output from TinyG's $$ command. Returns
+       a (group_id, key, val) tuple, or None if the line doesn't contain a
+       configuration item.
+    """
+    if not line.startswith('['):
+        return None
+    fields = line.split()
+    end = fields[0].find(']')
+    if end < 0:
+        return None
+    group_key = id_to_group_key(fields[0][1:end])
+    if group_key is None:
+        return None
+    val_str = None
+    if group_key == ('sys', 'id'):
+        # id is the only non-numeric field
+        if len(fields) > 3:
+            val_str = fields[3]
+    else:
+        for field in fields[1:]:
+            if is_number(field):
+                val_str = field
+                break
+    if val_str is None:
+        return None
+    return (group_key[0], group_key[1], get_val(val_str))
+
+def parse_text_lines(lines, config=None):
+    """Generator which parses lines of $$ output (from any iterable, so a
+       file is read a line at a time) and yields a (group_id, key, val) tuple
+       for each configuration item. Each item is also merged into 'config',
+       if one is given, as soon as it's parsed.
+    """
+    for line in lines:
+        entry = parse_text_line(line)
+        if entry is None:
+            continue
+        if config is not None:
+            if config.verbose:
+                print("Parsed key '%s' val '%s'" % entry[1:])
+            config.add_group({entry[0] : {entry[1] : entry[2]}})
+        yield entry
+
+
+class TextParser(object):
+    """Incrementally parses $$ output which arrives a chunk at a time (for
+       example straight from a serial port), without needing to collect
+       the whole output first. Partial lines are held until the rest of the
+       line arrives.
+    """
+
+    def __init__(self, config=None):
+        self.config = config
+        self.partial = ''
+
+    def feed(self, data):
+        """Parses 'data' (a string containing any number of lines, or parts
+           of lines), and returns a list of the (group_id, key, val) tuples
+           for the items which were completed.
+        """
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return list(parse_text_lines(lines, self.config))
+
+    def close(self):
+        """Parses any partial line which is left over, and returns a list
+           of its items (as for feed).
+        """
+        partial, self.partial = self.partial, ''
+        return list(parse_text_lines([partial], self.config))
 
 
 class Config(object):
@@ -215,45 +573,29 @@ class Config(object):
         """
         print(json.dumps(self.config, indent=2, sort_keys=True))
 
-    def dump_formatted(self):
+    def dump_formatted(self, file=None):
         """Dumps the contents of the configuration using the text output
            that TinyG produces. This will be almost identical to the output
-           produced by the $$ command in TinyG.
+           produced by the $$ command in TinyG. The output is written to
+           'file' (sys.stdout if file is None) using a single write.
         """
-        for mapEntry in CONFIG_MAP:
-            prefix = mapEntry[0]
-            if prefix not in self.config:
+        if file is None:
+            file = sys.stdout
+        file.write(self.format_text())
+
+    def format_text(self):
+        """Returns the text which dump_formatted writes, as a string."""
+        lines = []
+        for (prefix, plan) in RENDER_PLANS:
+            vals = self.config.get(prefix)
+            if not vals:
                 continue
-            vals = self.config[prefix]
-            mapPrefix = mapEntry[1]
-            strs = CONFIG_STR[mapPrefix]
-            for strEntry in strs:
-                key = strEntry[0]
+            for (key, left, units) in plan:
                 if key in vals:
-                    descr = strEntry[1]
-                    if mapPrefix == '1':
-                        descr = 'm{:s} {:s}'.format(prefix, descr)
-                    elif mapPrefix in 'xagh':
-                        descr = '{:s} {:s}'.format(prefix, descr)
-                    units = strEntry[2]
-                    if prefix == 'sys':
-                        fmt_key = '[' + key + ']'
-                    else:
-                        fmt_key = '[' + prefix + key + ']'
-                    val = vals[key]
-                    if key == "am":
-                        units = '{{:d}} {:s}'.format(AXIS_MODE[val])
-                    left = '{:5s} {:29s}'.format(fmt_key, descr)[:35]
-                    right = units.format(val)
-                    space = right.find(' ')
-                    period = right.find('.')
-                    align = space
-                    if period > 0 and ((space < 0) or (space > 0 and period < space)):
-                        align = period
-                    if align < 0:
-                        align = 1
-                    #print("space =", space, "period =", period, "align =",  align)
-                    print(left[:-(align + 1)] + ' ' + right)
+                    lines.append(render_line(left, units, key, vals[key]))
+        if not lines:
+            return ''
+        return '\n'.join(lines) + '\n'
 
     def add_group(self, group_dict):
         """Merges a set of parameters described by group_dict, into the
@@ -275,19 +617,77 @@ class Config(object):
         if group_id in self.config:
             return self.config[group_id].copy()
 
+    def diff(self, other):
+        """Compares this configuration against 'other' (typically the
+           configuration read from the board). Returns a tuple containing
+           a Config with the items whose values differ (or are missing from
+           'other'), and a list of (group_id, key) tuples which were the same.
+           Read-only items are in neither, since they're never written.
+        """
+        changed = Config(verbose=self.verbose)
+        same = []
+        for group_id in self.config:
+            other_group = other.get_group(group_id) or {}
+            read_only = CONFIG_READ_ONLY.get(group_id, ())
+            for key, val in self.config[group_id].items():
+                if key in read_only:
+                    continue
+                if key in other_group and values_equal(val, other_group[key]):
+                    same.append((group_id, key))
+                else:
+                    changed.add_group({group_id : {key : val}})
+        return (changed, same)
+
+    def validate(self, strict=True):
+        """Checks the configuration against the items described by
+           CONFIG_STR, without talking to a TinyG. Returns a tuple containing
+           a list of errors and a list of warnings, each of which is a
+           (group_id, key, message) tuple (key is None for a whole group).
+           Problems with read-only items are only warnings, since they're
+           never written to the TinyG. Unknown groups and items are errors
+           if 'strict' is True, otherwise they're warnings (they may have
+           come from firmware newer than CONFIG_STR).
+        """
+        errors = []
+        warnings = []
+        unknown = errors if strict else warnings
+        for group_id in sorted(self.config):
+            group = self.config[group_id]
+            if group_id not in VALIDATORS:
+                unknown.append((group_id, None, "unknown group"))
+                continue
+            if not isinstance(group, dict):
+                errors.append((group_id, None, "should be a group of items"))
+                continue
+            rules = VALIDATORS[group_id]
+            read_only = CONFIG_READ_ONLY.get(group_id, ())
+            for key in sorted(group):
+                if key not in rules:
+                    unknown.append((group_id, key, "unknown item"))
+                    continue
+                problem = check_value(group[key], *rules[key])
+                if problem is None:
+                    continue
+                if key in read_only:
+                    warnings.append((group_id, key, problem + " (read-only)"))
+                else:
+                    errors.append((group_id, key, problem))
+        return (errors, warnings)
+
     def read(self, file):
         """Checks to see if the first character is '{". If so, it considers
            this to be a JSON file. otherwise it assumes it's a text format.
+           Text files are parsed a line at a time, as they're read.
         """
-        lines = file.readlines()
-        if lines and lines[0] and lines[0][0] != '{':
+        first_line = file.readline()
+        if first_line and first_line[0] != '{':
             if self.verbose:
                 print("Looks like a TEXT file")
-            self.read_text(lines)
+            self.read_text(itertools.chain([first_line], file))
             return
         if self.verbose:
             print("Looks like a JSON file")
-        cfg_dict = json.loads(' '.join(lines))
+        cfg_dict = json.loads(first_line + file.read())
         for key in cfg_dict:
             if self.verbose:
                 print('JSON:', key, ':', json.dumps(cfg_dict[key]))
@@ -295,27 +695,10 @@ class Config(object):
 
     def read_text(self, lines):
         """Parses a text file which contains lines produced by TinyG's $$
-           command in text mode.
+           command in text mode. 'lines' may be any iterable (i.e. a file).
         """
-        for line in lines:
-            if line[0] != '[':
-                continue
-            line = line.strip()
-            fields = line.split()
-            key = re.search(r'\[(.*)\]', fields[0]).group(1)
-            val_str = None
-            if key == 'id':
-                # id is the only non-numeric field
-                val_str = fields[3]
-            else:
-                for field in fields[1:]:
-                    if is_number(field):
-                        val_str = field
-                        break
-            if self.verbose:
-                print("Parsed key '%s' val '%s'" % (key,  val_str))
-            (group_id, group_key) = id_to_group_key(key)
-            self.add_group({group_id : {group_key : get_val(val_str)}})
+        for _ in parse_text_lines(lines, self):
+            pass
 
     def write(self, file):
         """Writes the configuration out as a JSON file.
@@ -324,22 +707,34 @@ class Config(object):
         file.write('\n')
 
 
-class TinyG(object):
-    """Class for talking to the TinyG. Currently this is just a hacked
-       together class. Eventually, I'll split this into a Bus style class
-       which has classes for talking serial, SPJS, and some type of simulation.
+class Bus(object):
+    """Base class for the transports used to talk to a TinyG. A bus moves
+       lines of bytes to and from the board, using the same methods as a
+       pyserial port, so that the TinyG class doesn't need to care which
+       kind of bus it's using.
     """
 
-    def __init__(self, verbose=False):
-        self.serial_port = None
-        self.verbose = verbose
+    def write(self, data):
+        """Sends 'data' (a bytes object) to the TinyG."""
+        raise NotImplementedError
 
-    def open_serial(self, port_name, baud):
-        """Opens the serial port for communicating with the TinyG board.
+    def readline(self, size):
+        """Returns the next line (up to 'size' bytes) received from the
+           TinyG, or an empty bytes object if nothing arrives before the
+           timeout.
         """
-        if self.serial_port:
-            # Already open
-            return
+        raise NotImplementedError
+
+    def close(self):
+        """Releases any resources used by the bus."""
+        pass
+
+
+class SerialBus(Bus):
+    """Bus for talking to a TinyG which is connected to a serial port."""
+
+    def __init__(self, port_name, baud):
+        import serial
         try:
             self.serial_port = serial.Serial(port=port_name,
                                              baudrate=baud,
@@ -352,98 +747,1804 @@ class TinyG(object):
                                              dsrdtr=False)
         except serial.serialutil.SerialException:
             raise IOError("Unable to open port '%s'\r" % port_name)
+
+    def write(self, data):
+        self.serial_port.write(data)
+
+    def readline(self, size):
+        return self.serial_port.readline(size)
+
+    def close(self):
+        self.serial_port.close()
+
+
+def default_cache_dir():
+    """Returns the directory used for the configuration cache and for
+       restore checkpoints.
+    """
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser('~/.cache'), 'tinyg-utils')
+
+def default_checkpoint_path(filename):
+    """Returns the name of the checkpoint file used when restoring the
+       configuration file 'filename'. Checkpoints are kept in the cache
+       directory, keyed by the file's absolute path, so that files in
+       read-only directories can still be restored.
+    """
+    import hashlib
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(default_cache_dir(), 'checkpoints', key + '.checkpoint')
+
+
+class ConfigCache(object):
+    """Stores the last configuration read from each board in a directory,
+       keyed by the board's id. A cached configuration is only used if the
+       board's sys group (which includes the firmware build and version)
+       still matches what was cached, so a single query of the sys group is
+       all that's needed to use it.
+    """
+
+    def __init__(self, cache_dir=None, verbose=False):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+
+    def filename(self, board_id):
+        """Returns the name of the file used to cache board_id."""
+        safe_id = ''.join(ch if ch.isalnum() or ch in '-_' else '_'
+                          for ch in str(board_id))
+        return os.path.join(self.cache_dir, safe_id + '.json')
+
+    def lookup(self, sys_group):
+        """Returns the cached Config for the board whose sys group is
+           'sys_group', or None if there isn't a usable one.
+        """
+        if not sys_group or 'id' not in sys_group:
+            return None
+        filename = self.filename(sys_group['id'])
+        try:
+            with open(filename, 'r') as file:
+                entry = json.load(file)
+        except (IOError, ValueError):
+            return None
+        if time.time() - entry.get('time', 0) > CACHE_MAX_AGE:
+            if self.verbose:
+                print("Cached configuration for '%s' has expired" % sys_group['id'])
+            return None
+        cached_sys = entry['config'].get('sys', {})
+        for key in sys_group:
+            if not values_equal(sys_group[key], cached_sys.get(key)):
+                if self.verbose:
+                    print("Cached configuration for '%s' is stale (%s changed)" %
+                          (sys_group['id'], key))
+                return None
+        # Mark the entry as recently used.
+        os.utime(filename, None)
+        if self.verbose:
+            print("Using cached configuration for '%s'" % sys_group['id'])
+        config = Config(verbose=self.verbose)
+        config.add_group(entry['config'])
+        return config
+
+    def store(self, config):
+        """Caches 'config', which must contain the board's sys group."""
+        sys_group = config.get_group('sys')
+        if not sys_group or 'id' not in sys_group:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entry = {
+            'id' : sys_group['id'],
+            'fb' : sys_group.get('fb'),
+            'fv' : sys_group.get('fv'),
+            'time' : time.time(),
+            'config' : config.config,
+        }
+        # Write to a temporary file, so that a reader never sees a partial
+        # entry.
+        filename = self.filename(sys_group['id'])
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(entry, file)
+        os.rename(filename + '.tmp', filename)
+        self.evict()
+
+    def invalidate(self, board_id):
+        """Removes any cached configuration for board_id."""
+        try:
+            os.remove(self.filename(board_id))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes expired entries, and all but the CACHE_MAX_ENTRIES most
+           recently used ones.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                filename = os.path.join(self.cache_dir, name)
+                entries.append((os.path.getmtime(filename), filename))
+        entries.sort(reverse=True)
+        now = time.time()
+        for i, (mtime, filename) in enumerate(entries):
+            if i >= CACHE_MAX_ENTRIES or now - mtime > CACHE_MAX_AGE:
+                os.remove(filename)
+
+
+class ArchiveStore(object):
+    """Stores snapshots of configurations in a directory. Each group of a
+       snapshot is stored as a blob named by the SHA-1 of its contents, so
+       groups which don't change from one snapshot to the next are only
+       stored once. The index (index.jsonl) has one line per snapshot,
+       giving its id, board id, time, and the blob used for each group.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index_filename = os.path.join(store_dir, 'index.jsonl')
+
+    def blob_filename(self, blob_id):
+        """Returns the name of the file used to store blob_id."""
+        return os.path.join(self.store_dir, 'blobs', blob_id[:2], blob_id + '.json')
+
+    def write_blob(self, group):
+        """Stores a group dictionary (if it isn't already stored) and returns
+           its blob id.
+        """
+        import hashlib
+        data = json.dumps(group, sort_keys=True, separators=(',', ':'))
+        blob_id = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        filename = self.blob_filename(blob_id)
+        if not os.path.exists(filename):
+            blob_dir = os.path.dirname(filename)
+            if not os.path.isdir(blob_dir):
+                os.makedirs(blob_dir)
+            with open(filename + '.tmp', 'w') as file:
+                file.write(data)
+            os.rename(filename + '.tmp', filename)
+        return blob_id
+
+    def read_blob(self, blob_id):
+        """Returns the group dictionary stored as blob_id."""
+        with open(self.blob_filename(blob_id), 'r') as file:
+            return json.load(file)
+
+    def add(self, config, timestamp=None):
+        """Stores 'config' as a new snapshot, and returns its index entry."""
+        import hashlib
+        if timestamp is None:
+            timestamp = time.time()
+        groups = {}
+        for group_id in sorted(config.config):
+            groups[group_id] = self.write_blob(config.config[group_id])
+        board_id = (config.get_group('sys') or {}).get('id', 'unknown')
+        snapshot_id = hashlib.sha1(to_json([board_id, timestamp, sorted(groups.items())])
+                                   .encode('utf-8')).hexdigest()
+        entry = {'id' : snapshot_id, 'board' : board_id, 'time' : timestamp,
+                 'groups' : groups}
+        with open(self.index_filename, 'a') as file:
+            file.write(json.dumps(entry, sort_keys=True) + '\n')
+        return entry
+
+    def history(self, board_id=None):
+        """Returns the index entries (oldest first), optionally only those
+           for board_id.
+        """
+        entries = []
+        if not os.path.exists(self.index_filename):
+            return entries
+        with open(self.index_filename, 'r') as file:
+            for line in file:
+                if line.strip():
+                    entry = json.loads(line)
+                    if board_id is None or entry['board'] == board_id:
+                        entries.append(entry)
+        entries.sort(key=lambda entry: entry['time'])
+        return entries
+
+    def find(self, ref):
+        """Returns the index entry referred to by 'ref', which is either a
+           prefix of a snapshot id, or BOARD@N / @N, where N indexes the
+           history (of BOARD) like a python list (so @-1 is the latest).
+        """
+        if '@' in ref:
+            board_id, index = ref.rsplit('@', 1)
+            entries = self.history(board_id or None)
+            try:
+                return entries[int(index)]
+            except (ValueError, IndexError):
+                raise ValueError("No snapshot matches '%s'" % ref)
+        matches = [entry for entry in self.history() if entry['id'].startswith(ref)]
+        if len(matches) != 1:
+            raise ValueError("%s snapshots match '%s'" %
+                             ('No' if not matches else 'Several', ref))
+        return matches[0]
+
+    def load(self, entry):
+        """Returns the Config for the snapshot described by the index entry."""
+        config = Config()
+        for group_id, blob_id in entry['groups'].items():
+            config.add_group({group_id : self.read_blob(blob_id)})
+        return config
+
+    def diff(self, entry1, entry2):
+        """Compares two snapshots group by group, and returns a list of
+           (group_id, key, val1, val2) tuples for the items which differ.
+           A value of None means that the item isn't in that snapshot. Only
+           the groups whose blobs differ are read.
+        """
+        groups1 = entry1['groups']
+        groups2 = entry2['groups']
+        diffs = []
+        for mapEntry in CONFIG_MAP:
+            group_id = mapEntry[0]
+            blob1 = groups1.get(group_id)
+            blob2 = groups2.get(group_id)
+            if blob1 == blob2:
+                continue
+            group1 = self.read_blob(blob1) if blob1 else {}
+            group2 = self.read_blob(blob2) if blob2 else {}
+            for key in sorted(set(group1) | set(group2)):
+                val1 = group1.get(key)
+                val2 = group2.get(key)
+                if val1 is None or val2 is None or not values_equal(val1, val2):
+                    diffs.append((group_id, key, val1, val2))
+        return diffs
+
+
+class ConfigTable(object):
+    """Lays out several configurations as a table, with one column per
+       configuration and one row per (group_id, key). Rows are in the same
+       order as the $$ output, followed by any keys which aren't described
+       by CONFIG_STR.
+    """
+
+    def __init__(self, names, configs):
+        self.names = names
+        self.rows = []
+        seen = set()
+        for mapEntry in CONFIG_MAP:
+            group_id = mapEntry[0]
+            columns = [config.config.get(group_id, {}) for config in configs]
+            for strEntry in GROUP_STRS[group_id]:
+                self.add_row(group_id, strEntry[0], columns, seen)
+        unknown = set()
+        for config in configs:
+            for group_id, group in config.config.items():
+                for key in group:
+                    if (group_id, key) not in seen:
+                        unknown.add((group_id, key))
+        for (group_id, key) in sorted(unknown):
+            columns = [config.config.get(group_id, {}) for config in configs]
+            self.add_row(group_id, key, columns, seen)
+
+    def add_row(self, group_id, key, columns, seen):
+        """Adds the row for (group_id, key), if any column has a value."""
+        values = [column.get(key) for column in columns]
+        if any(val is not None for val in values):
+            self.rows.append(((group_id, key), values))
+            seen.add((group_id, key))
+
+    def differing_rows(self):
+        """Returns the rows whose values aren't all the same."""
+        result = []
+        for row in self.rows:
+            values = row[1]
+            first = values[0]
+            if any(val is None or first is None or not values_equal(first, val)
+                   for val in values[1:]):
+                result.append(row)
+        return result
+
+    @staticmethod
+    def outliers(values):
+        """Returns a list of booleans indicating which of the numeric values
+           are outliers, using the modified z-score
+           0.6745 * (x - median) / MAD, where MAD is the median absolute
+           deviation. If more than half of the values are the same (MAD is
+           zero) then every value which differs from them is an outlier.
+        """
+        numbers = [val for val in values
+                   if isinstance(val, (int, float)) and not isinstance(val, bool)]
+        if len(numbers) < 3:
+            return [False] * len(values)
+        median = sorted(numbers)[len(numbers) // 2]
+        deviations = sorted(abs(val - median) for val in numbers)
+        mad = deviations[len(deviations) // 2]
+        result = []
+        for val in values:
+            if val not in numbers:
+                result.append(False)
+            elif mad == 0:
+                result.append(not values_equal(val, median))
+            else:
+                result.append(0.6745 * abs(val - median) / mad > OUTLIER_THRESHOLD)
+        return result
+
+    def dump(self, width=12):
+        """Prints the rows which differ, marking outliers with '*'."""
+        rows = self.differing_rows()
+        cells = ['{:10s}'.format('')]
+        cells += ['{:>{}s}'.format(name[-width:], width) for name in self.names]
+        print(' '.join(cells))
+        for ((group_id, key), values) in rows:
+            cells = ['{:10s}'.format('[%s]' % (key if group_id == 'sys' else group_id + key))]
+            for val, outlier in zip(values, self.outliers(values)):
+                text = '-' if val is None else str(val)
+                cells.append('{:>{}s}'.format(text + ('*' if outlier else ' '), width))
+            print(' '.join(cells))
+        print("%d of %d item(s) differ" % (len(rows), len(self.rows)))
+
+
+class Stats(object):
+    """Collects statistics about the traffic between the host and a TinyG:
+       bytes and lines in each direction, the number of timeouts, retries,
+       and received lines which weren't responses, and a latency histogram
+       for each group (or other name) which was sent.
+    """
+
+    # Upper bounds (in milliseconds) of the latency histogram buckets. The
+    # last bucket holds everything larger.
+    LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.lines_sent = 0
+        self.bytes_recv = 0
+        self.lines_recv = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.discarded = 0
+        self.latencies = {}
+        self.send_times = {}
+
+    def sent(self, line, names):
+        """Records that 'line' was sent, for the items given by 'names'."""
+        self.bytes_sent += len(line) + 1
+        self.lines_sent += 1
+        now = time.time()
+        for name in names:
+            self.send_times[name] = now
+
+    def received(self, num_bytes):
+        """Records that a line containing num_bytes was received."""
+        self.bytes_recv += num_bytes
+        self.lines_recv += 1
+
+    def responded(self, names):
+        """Records that a response was received for the items in 'names'."""
+        now = time.time()
+        for name in names:
+            send_time = self.send_times.pop(name, None)
+            if send_time is not None:
+                self.add_latency(name, now - send_time)
+
+    def add_latency(self, name, latency):
+        """Adds a single latency (in seconds) to the histogram for name."""
+        entry = self.latencies.get(name)
+        if entry is None:
+            entry = {'count' : 0, 'total' : 0.0, 'min' : latency, 'max' : latency,
+                     'buckets' : [0] * (len(self.LATENCY_BUCKETS) + 1)}
+            self.latencies[name] = entry
+        entry['count'] += 1
+        entry['total'] += latency
+        entry['min'] = min(entry['min'], latency)
+        entry['max'] = max(entry['max'], latency)
+        latency_ms = latency * 1000
+        bucket = 0
+        while bucket < len(self.LATENCY_BUCKETS) and latency_ms > self.LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        entry['buckets'][bucket] += 1
+
+    def merge(self, other):
+        """Adds the statistics collected in 'other' into this object."""
+        self.bytes_sent += other.bytes_sent
+        self.lines_sent += other.lines_sent
+        self.bytes_recv += other.bytes_recv
+        self.lines_recv += other.lines_recv
+        self.timeouts += other.timeouts
+        self.retries += other.retries
+        self.discarded += other.discarded
+        for name, other_entry in other.latencies.items():
+            entry = self.latencies.get(name)
+            if entry is None:
+                self.latencies[name] = json.loads(json.dumps(other_entry))
+                continue
+            entry['count'] += other_entry['count']
+            entry['total'] += other_entry['total']
+            entry['min'] = min(entry['min'], other_entry['min'])
+            entry['max'] = max(entry['max'], other_entry['max'])
+            entry['buckets'] = [a + b for a, b in zip(entry['buckets'], other_entry['buckets'])]
+
+    def to_dict(self):
+        """Returns the statistics as a dictionary suitable for JSON."""
+        return {
+            'bytes_sent' : self.bytes_sent,
+            'lines_sent' : self.lines_sent,
+            'bytes_recv' : self.bytes_recv,
+            'lines_recv' : self.lines_recv,
+            'timeouts' : self.timeouts,
+            'retries' : self.retries,
+            'discarded' : self.discarded,
+            'latency_buckets_ms' : list(self.LATENCY_BUCKETS),
+            'latencies' : self.latencies,
+        }
+
+    def summary(self):
+        """Returns a human readable summary of the statistics."""
+        lines = [
+            'Sent:      %d bytes in %d lines' % (self.bytes_sent, self.lines_sent),
+            'Received:  %d bytes in %d lines' % (self.bytes_recv, self.lines_recv),
+            'Timeouts:  %d' % self.timeouts,
+            'Retries:   %d' % self.retries,
+            'Discarded: %d lines which were not expected responses' % self.discarded,
+        ]
+        if self.latencies:
+            lines.append('Latency (ms):   count     min    mean     max')
+            for name in sorted(self.latencies):
+                entry = self.latencies[name]
+                lines.append('  %-12s %7d %7.1f %7.1f %7.1f' % (
+                    name, entry['count'], entry['min'] * 1000,
+                    entry['total'] * 1000 / entry['count'], entry['max'] * 1000))
+        return '\n'.join(lines)
+
+
+class CompactConfig(object):
+    """Holds a TinyG configuration using much less memory than Config, for
+       when many configurations need to be kept in memory at once. Each item
+       described by CONFIG_STR has a fixed slot in a single array of doubles,
+       with a parallel array recording whether the slot holds an int, a
+       float, or nothing. Anything else (strings like the board id, and
+       groups or keys which CONFIG_STR doesn't describe) is kept in a small
+       dictionary on the side. Conversion to and from Config is lossless.
+    """
+
+    __slots__ = ('values', 'types', 'extras', 'verbose')
+
+    # Integers larger than this can't be stored exactly in a double.
+    MAX_EXACT_INT = 2 ** 53
+
+    def __init__(self, verbose=False):
+        self.values = array('d', [0.0]) * NUM_SLOTS
+        self.types = bytearray(NUM_SLOTS)
+        self.extras = None
+        self.verbose = verbose
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns a CompactConfig holding the same items as 'config'."""
+        compact = cls(verbose=config.verbose)
+        compact.add_group(config.config)
+        return compact
+
+    def to_config(self):
+        """Returns a Config holding the same items as this object."""
+        config = Config(verbose=self.verbose)
+        config.config = self.config
+        return config
+
+    @property
+    def config(self):
+        """The configuration as a 2 level dictionary (see Config)."""
+        result = {}
+        for group_id in self.group_ids():
+            result[group_id] = self.get_group(group_id)
+        return result
+
+    def group_ids(self):
+        """Returns the ids of the groups which have at least one item."""
+        group_ids = []
+        for mapEntry in CONFIG_MAP:
+            group_id = mapEntry[0]
+            if any(self.types[slot] for slot in SLOT_INDEX[group_id].values()):
+                group_ids.append(group_id)
+        for group_id in self.extras or ():
+            if group_id not in group_ids:
+                group_ids.append(group_id)
+        return group_ids
+
+    def add_group(self, group_dict):
+        """Merges a set of parameters described by group_dict, into the
+           configuration.
+        """
+        for group_id, group in group_dict.items():
+            group_slots = SLOT_INDEX.get(group_id, {})
+            for key, val in group.items():
+                slot = group_slots.get(key)
+                if slot is not None:
+                    if isinstance(val, float):
+                        self.values[slot] = val
+                        self.types[slot] = SLOT_FLOAT
+                        self.discard_extra(group_id, key)
+                        continue
+                    if isinstance(val, int) and not isinstance(val, bool) and \
+                            abs(val) <= self.MAX_EXACT_INT:
+                        self.values[slot] = val
+                        self.types[slot] = SLOT_INT
+                        self.discard_extra(group_id, key)
+                        continue
+                    self.types[slot] = SLOT_EMPTY
+                if self.extras is None:
+                    self.extras = {}
+                self.extras.setdefault(group_id, {})[key] = val
+
+    def discard_extra(self, group_id, key):
+        """Removes (group_id, key) from the extras, if it's there."""
+        if self.extras and key in self.extras.get(group_id, ()):
+            del self.extras[group_id][key]
+            if not self.extras[group_id]:
+                del self.extras[group_id]
+
+    def get_group(self, group_id):
+        """Returns the configuration items which belong to the group named
+           by group_id.
+        """
+        group = {}
+        for key, slot in SLOT_INDEX.get(group_id, {}).items():
+            slot_type = self.types[slot]
+            if slot_type == SLOT_INT:
+                group[key] = int(self.values[slot])
+            elif slot_type == SLOT_FLOAT:
+                group[key] = self.values[slot]
+        if self.extras and group_id in self.extras:
+            group.update(self.extras[group_id])
+        if group:
+            return group
+
+    def dump(self):
+        """Dumps the configuration as JSON (see Config.dump)."""
+        self.to_config().dump()
+
+    def dump_formatted(self, file=None):
+        """Dumps the configuration like TinyG's $$ command (see
+           Config.dump_formatted).
+        """
+        self.to_config().dump_formatted(file)
+
+    def read(self, file):
+        """Reads a JSON or text configuration file (see Config.read)."""
+        config = Config(verbose=self.verbose)
+        config.read(file)
+        self.add_group(config.config)
+
+    def write(self, file):
+        """Writes the configuration out as a JSON file."""
+        self.to_config().write(file)
+
+
+class TelemetryRecorder(object):
+    """Records the status (sr) and queue (qr) reports sent by the TinyG.
+       The most recent reports are kept in a bounded ring buffer, and every
+       report is also written to 'file' as a line of JSON. Lines are
+       written in batches, to avoid a write for every report. Reports can
+       be downsampled by only keeping every 'every'th report of each kind,
+       and/or only keeping reports which are at least 'min_interval'
+       seconds apart.
+    """
+
+    def __init__(self, file, every=1, min_interval=0, ring_size=TELEMETRY_RING_SIZE):
+        self.file = file
+        self.every = max(1, every)
+        self.min_interval = min_interval
+        self.ring = collections.deque(maxlen=ring_size)
+        self.batch = []
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+        self.counts = {}
+        self.last_kept = {}
+        self.recorded = 0
+        self.skipped = 0
+
+    def record(self, name, value):
+        """Records a report. This is passed to TinyG.subscribe, so it gets
+           called from the reader thread.
+        """
+        now = time.time()
+        with self.lock:
+            count = self.counts.get(name, 0)
+            self.counts[name] = count + 1
+            if count % self.every != 0 or \
+                    now - self.last_kept.get(name, 0) < self.min_interval:
+                self.skipped += 1
+                return
+            self.last_kept[name] = now
+            self.ring.append((now, name, value))
+            self.batch.append(to_json({'t' : round(now, 3), name : value}))
+            self.recorded += 1
+            if len(self.batch) >= TELEMETRY_FLUSH_COUNT or \
+                    now - self.last_flush >= TELEMETRY_FLUSH_INTERVAL:
+                self.flush_locked()
+
+    def flush(self):
+        """Writes any reports which haven't been written yet."""
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        """Same as flush, but the caller must already hold the lock."""
+        if self.batch:
+            self.file.write('\n'.join(self.batch) + '\n')
+            self.file.flush()
+            self.batch = []
+        self.last_flush = time.time()
+
+    def recent(self, name=None):
+        """Returns the reports in the ring buffer (oldest first) as a list
+           of (time, name, value) tuples, optionally only those for name.
+        """
+        with self.lock:
+            return [entry for entry in self.ring if name is None or entry[1] == name]
+
+
+def gcode_lines(file):
+    """Generator which reads lines of gcode from 'file' a line at a time,
+       removing comments and whitespace, and skipping empty lines.
+    """
+    for line in file:
+        # Remove ; comments, and (parenthesized) comments.
+        line = line.split(';', 1)[0]
+        while '(' in line:
+            start = line.index('(')
+            end = line.find(')', start)
+            line = line[:start] + (line[end + 1:] if end >= 0 else '')
+        line = line.strip()
+        if line:
+            yield line
+
+
+class GcodeStreamer(object):
+    """Streams lines of gcode to the TinyG, keeping its receive buffer and
+       motion planner full without overflowing them. Lines are sent as long
+       as the characters sent but not yet responded to fit in the receive
+       buffer (character counting). In addition, if the TinyG sends queue
+       reports, sending pauses while fewer than PLANNER_LOW_WATER planner
+       buffers are free.
+    """
+
+    def __init__(self, tinyg):
+        self.tinyg = tinyg
+        self.cond = threading.Condition()
+        self.planner_free = None
+        self.lines_sent = 0
+        self.errors = 0     # lines which were too long or were rejected
+
+    def queue_report(self, name, value):
+        """Called from the reader thread for each queue report."""
+        if isinstance(value, dict):
+            # Triple queue reports look like {"qr":n,"qi":n,"qo":n}
+            value = value.get('qr')
+        with self.cond:
+            self.planner_free = value
+            self.cond.notify_all()
+
+    def wait_for_planner(self):
+        """Waits until the planner has room (if queue reports are on)."""
+        deadline = time.time() + STREAM_RESPONSE_TIMEOUT
+        with self.cond:
+            while self.planner_free is not None and \
+                    self.planner_free < PLANNER_LOW_WATER:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TinyGTimeout("Timed out waiting for the planner")
+                self.cond.wait(remaining)
+
+    def wait_for_response(self, in_flight):
+        """Waits for the response to the oldest line in flight, and
+           reports the line if the TinyG rejected it.
+        """
+        status = self.tinyg.read_response(STREAM_RESPONSE_TIMEOUT, with_status=True)[1]
+        line = in_flight.popleft()
+        if status is not None and status != STAT_OK:
+            print("Line rejected by the TinyG (status %d): '%s'" % (status, line))
+            self.errors += 1
+
+    def stream(self, lines):
+        """Sends each line from 'lines' (any iterable, such as the generator
+           returned by gcode_lines) and waits for all of the responses.
+        """
+        in_flight = collections.deque()  # lines awaiting responses
+        in_flight_bytes = 0
+        self.tinyg.discard_responses()
+        self.tinyg.subscribe(self.queue_report, ('qr',))
+        try:
+            for line in lines:
+                line_bytes = len(line) + 1
+                if line_bytes > MAX_LINE_LEN:
+                    print("Skipping line which is too long: '%s'" % line)
+                    self.errors += 1
+                    continue
+                while in_flight and in_flight_bytes + line_bytes > RX_BUFFER_SIZE:
+                    in_flight_bytes -= len(in_flight[0]) + 1
+                    self.wait_for_response(in_flight)
+                self.wait_for_planner()
+                with self.cond:
+                    # The queue report for this line hasn't arrived yet, so
+                    # assume that it's going to use up a buffer.
+                    if self.planner_free is not None:
+                        self.planner_free -= 1
+                self.tinyg.send_line(line)
+                in_flight.append(line)
+                in_flight_bytes += line_bytes
+                self.lines_sent += 1
+            while in_flight:
+                self.wait_for_response(in_flight)
+        finally:
+            self.tinyg.unsubscribe(self.queue_report)
+
+
+class RestoreCheckpoint(object):
+    """Records which of the commands of a restore have been acknowledged
+       by the TinyG, in a file, so that an interrupted restore can be
+       resumed from where it left off. The checkpoint only applies to the
+       exact same list of commands (it stores a hash of them).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.plan = None
+        self.acked = set()
+
+    def load(self, cmds):
+        """Starts a restore which sends the commands in 'cmds'. Returns the
+           set of indices of the commands which were acknowledged by an
+           earlier attempt at the same restore.
+        """
+        import hashlib
+        self.plan = hashlib.sha1(json.dumps(cmds, sort_keys=True)
+                                 .encode('utf-8')).hexdigest()
+        self.acked = set()
+        try:
+            with open(self.filename, 'r') as file:
+                saved = json.load(file)
+        except (IOError, ValueError):
+            return self.acked
+        if saved.get('plan') == self.plan:
+            self.acked = set(saved.get('acked', ()))
+        return self.acked
+
+    def ack(self, index):
+        """Records that the command at 'index' was acknowledged. If the
+           checkpoint can't be written, then a warning is printed and the
+           restore carries on without it.
+        """
+        self.acked.add(index)
+        if self.filename is None:
+            return
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.filename + '.tmp', 'w') as file:
+                json.dump({'plan' : self.plan, 'acked' : sorted(self.acked)}, file)
+            os.rename(self.filename + '.tmp', self.filename)
+        except (IOError, OSError) as err:
+            print("Warning: can't write the checkpoint (%s), so this restore "
+                  "can't be resumed" % err)
+            self.filename = None
+
+    def remove(self):
+        """Removes the checkpoint, once the restore has completed."""
+        if self.filename is None:
+            return
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class TinyGTimeout(IOError):
+    """Raised when the TinyG doesn't respond to a request in time."""
+    pass
+
+
+class TinyG(object):
+    """Class for talking to the TinyG. The actual communication is done
+       using a Bus object, which may be a serial port or a simulation
+       (see TinyGSim.py).
+    """
+
+    def __init__(self, verbose=False, pipeline=False, combine_groups=False,
+                 stats=None, name=None):
+        self.bus = None
+        self.name = name
+        self.verbose = verbose
+        self.pipeline = pipeline
+        self.combine_groups = combine_groups
+        self.stats = stats
+        self.response_timeout = 1.0 # seconds
+        self.responses = queue.Queue()
+        self.subscribers = []
+        self.reader = None
+
+    def open_serial(self, port_name, baud):
+        """Opens the serial port for communicating with the TinyG board.
+        """
+        if self.bus:
+            # Already open
+            return
+        self.open_bus(SerialBus(port_name, baud))
+
+    def open_bus(self, bus):
+        """Starts communicating with the TinyG using 'bus'. A reader thread
+           is started which handles all of the data received from the TinyG.
+        """
+        self.bus = bus
+        self.reader = threading.Thread(target=self.read_loop, args=(bus,),
+                                       name='TinyG reader')
+        self.reader.daemon = True
+        self.reader.start()
         # Make sure that we're in metric mode.
-        self.send_json({'gc' : 'G21'})
-        self.read_response()
+        self.request({'gc' : 'G21'})
+
+    def close(self):
+        """Closes the bus used to communicate with the TinyG."""
+        if self.bus:
+            bus, self.bus = self.bus, None
+            # Closing the bus wakes up the reader, which then notices that
+            # the bus has changed and exits.
+            bus.close()
+            self.reader.join(self.response_timeout * 2)
+            self.reader = None
 
-    def send_line(self, line):
-        self.serial_port.write(line.encode('ascii'))
-        self.serial_port.write(b'\n')
+    def subscribe(self, callback, names=('sr', 'qr')):
+        """Arranges for callback(name, value) to be called from the reader
+           thread whenever the TinyG sends a report whose name is in 'names'
+           (i.e. 'sr' for status reports or 'qr' for queue reports). Lines
+           which aren't JSON are reported using the name 'text', so passing
+           them to a TextParser will parse the output of $$ in text mode.
+        """
+        self.subscribers.append((callback, names))
+
+    def unsubscribe(self, callback):
+        """Stops calling a callback which was passed to subscribe."""
+        self.subscribers = [entry for entry in self.subscribers
+                            if entry[0] != callback]
+
+    def report(self, msg):
+        """Prints a message, prefixed by the TinyG's name (if it has one) so
+           that messages from several boards can be told apart.
+        """
+        if self.name:
+            msg = '%s: %s' % (self.name, msg)
+        print(msg)
+
+    def send_line(self, line, names=()):
+        """Sends a line to the TinyG. 'names' are the items which the line
+           asks for, which are used to measure the latency of the response.
+        """
+        self.bus.write(line.encode('ascii') + b'\n')
+        if self.stats:
+            self.stats.sent(line, names)
         if self.verbose:
-            print("Sent: '%s'" % line)
+            self.report("Sent: '%s'" % line)
 
     def send_json(self, cmd_dict):
         """Formats 'cmd_dict' as JSON, and sends it over the serial port to
            the TinyG.
         """
-        self.send_line(json.dumps(cmd_dict))
+        self.send_line(to_json(cmd_dict), cmd_dict)
 
-    def recv_json(self):
+    def recv_json(self, bus):
         """Reads a line of data from the TinyG and decodes is as JSON. Returns
-           the parsed dictionay.
+           the parsed dictionay, or None if nothing was received. Lines which
+           aren't JSON (i.e. text mode output) are returned as {'text': line}.
         """
-        line = self.serial_port.readline(512).decode('ascii')
-        if line:
-            if self.verbose:
-                print("Rcvd: '%s'" % line.strip())
+        line = bus.readline(512).decode('ascii')
+        if not line:
+            return None
+        if self.stats:
+            self.stats.received(len(line))
+        if self.verbose:
+            self.report("Rcvd: '%s'" % line.strip())
+        try:
             return json.loads(line)
-        print("Timed out")
+        except ValueError:
+            return {'text' : line.rstrip('\r\n')}
+
+    def read_loop(self, bus):
+        """Runs in the reader thread. Reads lines from the TinyG and routes
+           responses to read_response and reports to the subscribers.
+        """
+        while self.bus is bus:
+            try:
+                msg = self.recv_json(bus)
+            except Exception as err:
+                if self.bus is bus:
+                    self.report("Reader stopped: %s" % err)
+                break
+            if not isinstance(msg, dict):
+                if msg is not None and self.stats:
+                    self.stats.discarded += 1
+                continue
+            if 'r' in msg:
+                # The footer is [protocol version, status code, ...]
+                footer = msg.get('f')
+                status = footer[1] if isinstance(footer, list) and len(footer) > 1 else None
+                self.responses.put((msg['r'], status))
+                continue
+            if self.stats:
+                self.stats.discarded += 1
+            for callback, names in self.subscribers:
+                for name in msg:
+                    if name in names:
+                        callback(name, msg[name])
 
-    def read_response(self):
-        """Reads lines from the TinyG until it gets one which contains a
-           response.
+    def read_response(self, timeout=None, cmd=None, with_status=False):
+        """Waits for the TinyG to send a response, and returns it. Raises
+           TinyGTimeout if no response arrives within 'timeout' seconds
+           (or response_timeout if 'timeout' is None). If 'cmd' is given,
+           then responses which don't match it (i.e. late responses to
+           earlier commands) are discarded. If 'with_status' is True, then
+           a (response, status) tuple is returned, where status is the
+           status code from the footer (None if there wasn't one).
         """
-        # We need the while loop because sometimes we get 'sr' style
-        # responses as well.
+        if timeout is None:
+            timeout = self.response_timeout
+        deadline = time.time() + timeout
         while True:
-            response = self.recv_json()
-            if not response:
-                # We timed out
-                return None
-            if 'r' in response:
-                return response['r']
+            try:
+                (response, status) = self.responses.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                if self.stats:
+                    self.stats.timeouts += 1
+                raise TinyGTimeout("Timed out waiting for a response from the TinyG")
+            if cmd is None or response_matches(cmd, response):
+                break
+            self.discard_response(response)
+        if self.stats and isinstance(response, dict):
+            self.stats.responded(response)
+        if with_status:
+            return (response, status)
+        return response
+
+    def discard_response(self, response):
+        """Called for a response which doesn't belong to the command that
+           it was received for.
+        """
+        if self.stats:
+            self.stats.discarded += 1
+        if self.verbose:
+            self.report("Discarded late response: '%s'" % to_json(response))
+
+    def discard_responses(self):
+        """Discards any responses which have already been received, since
+           they belong to commands which have already timed out.
+        """
+        while True:
+            try:
+                (response, _) = self.responses.get_nowait()
+            except queue.Empty:
+                return
+            self.discard_response(response)
+
+    def request(self, cmd, retries=0):
+        """Sends the command dictionary 'cmd' to the TinyG and returns the
+           response which matches it. The command is resent up to 'retries'
+           times if it isn't answered, after which TinyGTimeout is raised.
+        """
+        self.discard_responses()
+        for attempt in range(retries + 1):
+            if attempt and self.stats:
+                self.stats.retries += 1
+            self.send_json(cmd)
+            try:
+                return self.read_response(cmd=cmd)
+            except TinyGTimeout:
+                if attempt == retries:
+                    raise
+
+    def read_group(self, group_id, retries=0):
+        """Reads a single group from the TinyG and returns it as a
+           dictionary. The query is resent up to 'retries' times.
+        """
+        response = self.request({group_id:None}, retries)
+        if isinstance(response, dict):
+            return response.get(group_id)
 
     def read_config(self, config):
         """Reads the configuration from the TinyG and merges it into the
-           configuration object given by 'config'.
+           configuration object given by 'config'. Returns a list of the
+           groups which couldn't be read.
         """
+        if self.pipeline:
+            return self.read_config_pipelined(config)
+        failed = []
         for mapEntry in CONFIG_MAP:
             group = mapEntry[0]
-            self.send_json({group:None})
-            response = self.read_response()
+            try:
+                response = self.request({group:None}, READ_RETRIES)
+            except TinyGTimeout:
+                self.report("Read of group config '%s' failed" % group)
+                failed.append(group)
+                continue
             if response:
                 config.add_group(response)
+        return failed
 
-    def write_config(self, config):
+    def read_config_pipelined(self, config):
+        """Reads the configuration from the TinyG, keeping as many group
+           queries in flight as will fit in the TinyG's receive buffer.
+           Responses are matched back to the group which requested them,
+           and queries whose response was lost are resent. Returns a list of
+           the groups which couldn't be read.
+        """
+        self.discard_responses()
+        pending = [mapEntry[0] for mapEntry in CONFIG_MAP]
+        retries = {}
+        failed = []
+        in_flight = []  # list of (group_id, bytes) in the order sent
+        while pending or in_flight:
+            in_flight_bytes = sum(entry[1] for entry in in_flight)
+            while pending:
+                group_id = pending[0]
+                line = to_json({group_id:None})
+                # Each line is followed by a newline
+                line_bytes = len(line) + 1
+                if in_flight and in_flight_bytes + line_bytes > RX_BUFFER_SIZE:
+                    break
+                pending.pop(0)
+                self.send_json({group_id:None})
+                in_flight.append((group_id, line_bytes))
+                in_flight_bytes += line_bytes
+            try:
+                response = self.read_response()
+            except TinyGTimeout:
+                # Everything still in flight was lost.
+                lost, in_flight = in_flight, []
+                self.requeue_lost(lost, pending, retries, failed)
+                continue
+            # TinyG processes lines in order, so a response normally belongs
+            # to the oldest query in flight. We match on the group key so
+            # that a lost response doesn't misattribute the ones after it.
+            index = None
+            for i, entry in enumerate(in_flight):
+                if response_matches({entry[0]:None}, response):
+                    index = i
+                    break
+            if index is None:
+                # A late response to a query which has already been given
+                # up on (and requested again).
+                self.discard_response(response)
+                continue
+            if retries.get(in_flight[index][0]):
+                # The query was resent, so this may be the late response to
+                # the original, which says nothing about the queries sent
+                # before the resend.
+                del in_flight[index]
+            else:
+                # Anything sent before the matched query can no longer be
+                # answered, so it needs to be requested again.
+                self.requeue_lost(in_flight[:index], pending, retries, failed)
+                del in_flight[:index + 1]
+            config.add_group(response)
+        return failed
+
+    def requeue_lost(self, lost, pending, retries, failed):
+        """Adds the groups from 'lost' (a list of (group_id, bytes) tuples)
+           back onto the pending list, unless they've been retried too often,
+           in which case they're added to 'failed'.
+        """
+        for group_id, _ in lost:
+            retries[group_id] = retries.get(group_id, 0) + 1
+            if retries[group_id] > PIPELINE_RETRIES:
+                self.report("Read of group config '%s' failed" % group_id)
+                failed.append(group_id)
+            else:
+                pending.append(group_id)
+                if self.stats:
+                    self.stats.retries += 1
+
+    def write_config(self, config, checkpoint=None):
         """Writes the configuration object given by 'config' to the TinyG.
            This will break the configuration up into sendable chunks.
+
+           If 'checkpoint' (a RestoreCheckpoint) is given, then commands
+           acknowledged by an earlier attempt are skipped, and each command
+           is recorded as it's acknowledged. A command which still isn't
+           acknowledged after WRITE_RETRIES retries raises TinyGTimeout,
+           leaving the checkpoint to resume from. Without a checkpoint, the
+           remaining commands are still sent, and a list of the groups whose
+           writes failed is returned.
         """
+        cmds = pack_commands(config, self.combine_groups)
+        acked = checkpoint.load(cmds) if checkpoint else ()
+        failed = []
+        for index, cmd in enumerate(cmds):
+            if index in acked:
+                continue
+            try:
+                self.request(cmd, WRITE_RETRIES)
+            except TinyGTimeout:
+                msg = "Write of group config '%s' failed" % "', '".join(sorted(cmd))
+                if checkpoint:
+                    raise TinyGTimeout(msg)
+                self.report(msg)
+                failed.extend(group_id for group_id in sorted(cmd)
+                              if group_id not in failed)
+                continue
+            if checkpoint:
+                checkpoint.ack(index)
+        if checkpoint:
+            checkpoint.remove()
+        return failed
+
+    def verify_config(self, config):
+        """Reads back the writable items of 'config' from the TinyG (using
+           as few queries as possible) and returns a list of
+           (group_id, key, expected, actual) tuples for the items whose
+           values don't match. actual is None if the item couldn't be read.
+        """
+        query = Config()
         for mapEntry in CONFIG_MAP:
             group_id = mapEntry[0]
-            group_config = config.get_group(group_id)
-            if not group_config:
-                continue
-            # Remove any read-only configs
-            filtered_config = group_config.copy()
-            if group_id in CONFIG_READ_ONLY:
-                for ro_key in CONFIG_READ_ONLY[group_id]:
-                    if ro_key in filtered_config:
-                        del filtered_config[ro_key]
-            # We only write 10 parameters at a time to ensure that we don't
-            # exceed the 254 character line length
-            # Python3 dict.keys returns a view (rather than a list), which is
-            # not sliceable.
-            filtered_keys = list(filtered_config.keys())
-            while filtered_keys:
-                key_slice = filtered_keys[:10]
-                del filtered_keys[:10]
-                self.send_json({group_id:{key : filtered_config[key] for key in key_slice}})
-                response = self.read_response()
-                if not response:
-                    print("Write of group config '%s' failed" % group)
-                    break
+            group = config.get_group(group_id)
+            if group:
+                query.add_group({group_id : {key : None for key in group}})
+        mismatches = []
+        for cmd in pack_commands(query, self.combine_groups):
+            try:
+                response = self.request(cmd, WRITE_RETRIES)
+            except TinyGTimeout:
+                response = {}
+            if not isinstance(response, dict):
+                response = {}
+            for group_id, keys in cmd.items():
+                actual_group = response.get(group_id) or {}
+                expected_group = config.get_group(group_id)
+                for key in keys:
+                    expected = expected_group[key]
+                    actual = actual_group.get(key)
+                    if actual is None or not values_equal(expected, actual):
+                        mismatches.append((group_id, key, expected, actual))
+        return mismatches
+
+    def write_config_diff(self, config, checkpoint=None):
+        """Reads the configuration currently on the TinyG, and then writes
+           only those items from 'config' whose values are different.
+           Returns a tuple containing a Config with the items which were
+           written, a list of (group_id, key) tuples which were skipped
+           because the board already had the same value, and a list of the
+           groups whose writes failed (see write_config).
+        """
+        live = Config(verbose=self.verbose)
+        self.read_config(live)
+        (changed, same) = config.diff(live)
+        failed = self.write_config(changed, checkpoint)
+        return (changed, same, failed)
+
+
+def open_tinyg(tinyg, args, port):
+    """Opens communications with the TinyG using the serial port named by
+       'port', or with a simulated TinyG if the --sim option was given.
+    """
+    if args.sim:
+        from TinyGSim import SimBus
+        sim_config = Config(verbose=args.verbose)
+        with open(args.sim, 'r') as file:
+            sim_config.read(file)
+        # Send status reports like the real board would.
+        sys_group = sim_config.get_group('sys') or {}
+        sr_interval = None
+        if sys_group.get('sv') and sys_group.get('si'):
+            sr_interval = sys_group['si'] / 1000.0
+        tinyg.open_bus(SimBus(sim_config, baud=args.baud, sr_interval=sr_interval))
+    else:
+        tinyg.open_serial(port, args.baud)
+
+def default_socket_path(port):
+    """Returns the name of the Unix socket used by the daemon which owns
+       the serial port named by 'port'.
+    """
+    return os.path.join('/tmp', 'tinyg-%s.sock' % os.path.basename(port))
+
+def daemon_request(socket_path, request):
+    """Sends 'request' (a dictionary) to the daemon listening on
+       socket_path, and returns the response dictionary. Returns None if no
+       daemon is running.
+    """
+    if not os.path.exists(socket_path):
+        return None
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            # Stale socket file - nobody is listening.
+            return None
+        sock.sendall(to_json(request).encode('ascii') + b'\n')
+        file = sock.makefile('rb')
+        line = file.readline()
+        file.close()
+    finally:
+        sock.close()
+    if not line:
+        raise IOError("No response from the daemon on '%s'" % socket_path)
+    response = json.loads(line.decode('ascii'))
+    if 'error' in response:
+        if response.get('timeout'):
+            raise TinyGTimeout(response['error'])
+        raise IOError(response['error'])
+    return response
+
+
+class ConfigDaemon(object):
+    """Owns the connection to a TinyG, and serves requests from other
+       invocations of Config.py over a Unix socket. A copy of the board's
+       configuration is kept, so that archive, dump, and show requests
+       don't need to talk to the board at all.
+    """
+
+    def __init__(self, tinyg, cache=None):
+        self.tinyg = tinyg
+        self.cache = cache
+        self.config = None
+        self.running = True
+
+    def refresh(self):
+        """Re-reads the cached configuration from the TinyG. If any group
+           can't be read, then TinyGTimeout is raised and nothing is kept,
+           so that the next request reads the board again.
+        """
+        self.config = None
+        config = Config(verbose=self.tinyg.verbose)
+        failed = self.tinyg.read_config(config)
+        if failed:
+            raise TinyGTimeout("Read of group config '%s' failed" % "', '".join(failed))
+        self.config = config
+
+    def handle_request(self, request):
+        """Handles a single request and returns the response dictionary."""
+        cmd = request.get('cmd')
+        if cmd in ('archive', 'dump', 'show', 'refresh'):
+            if self.config is None or cmd == 'refresh' or request.get('refresh'):
+                self.refresh()
+            return {'config' : self.config.config}
+        if cmd == 'restore':
+            config = Config(verbose=self.tinyg.verbose)
+            config.add_group(request['config'])
+            checkpoint = None
+            if request.get('checkpoint'):
+                checkpoint = RestoreCheckpoint(request['checkpoint'])
+            response = {}
+            if request.get('diff') and self.config is None:
+                self.refresh()
+            written = config
+            try:
+                if request.get('diff'):
+                    (written, same) = config.diff(self.config)
+                    self.tinyg.write_config(written, checkpoint)
+                    response['skipped'] = same
+                else:
+                    self.tinyg.write_config(config, checkpoint)
+            except TinyGTimeout:
+                # The board is partly written, so re-read it next time.
+                self.config = None
+                raise
+            finally:
+                if self.cache:
+                    invalidate_cached_config(self.cache, self.tinyg, config)
+            if request.get('verify'):
+                response['mismatches'] = self.tinyg.verify_config(written)
+            # Pick up the values as the board stored them. If that fails,
+            # the board is read again by the next request.
+            try:
+                self.refresh()
+            except TinyGTimeout:
+                pass
+            return response
+        if cmd == 'ping':
+            return {}
+        if cmd == 'stop':
+            self.running = False
+            return {}
+        return {'error' : "Unrecognized daemon command '%s'" % cmd}
+
+
+def serve_daemon_connection(daemon, conn):
+    """Handles a connection to the daemon. Each connection carries a
+       single JSON request line, and gets back a single JSON response line.
+    """
+    file = conn.makefile('rb')
+    line = file.readline()
+    file.close()
+    if not line:
+        return
+    try:
+        response = daemon.handle_request(json.loads(line.decode('ascii')))
+    except TinyGTimeout as err:
+        response = {'error' : str(err), 'timeout' : True}
+    except Exception as err:
+        response = {'error' : str(err) or err.__class__.__name__}
+    conn.sendall(to_json(response).encode('ascii') + b'\n')
+
+def run_daemon(tinyg, args, socket_path):
+    """Opens the TinyG, and then serves requests on socket_path until a
+       stop request is received or the program is interrupted.
+    """
+    import socket
+    if daemon_request(socket_path, {'cmd' : 'ping'}) is not None:
+        print("A daemon is already running on '%s'" % socket_path)
+        return
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    open_tinyg(tinyg, args, args.port)
+    daemon = ConfigDaemon(tinyg, None if args.sim else ConfigCache(verbose=args.verbose))
+    try:
+        daemon.refresh()
+    except TinyGTimeout as err:
+        # The board is read again by the first request.
+        print(err)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(5)
+    print("Serving '%s' on '%s'" % (args.port, socket_path))
+    try:
+        # Requests are handled one at a time, since they share the TinyG.
+        while daemon.running:
+            conn = server.accept()[0]
+            try:
+                serve_daemon_connection(daemon, conn)
+            except socket.error as err:
+                # i.e. the client went away before getting its response.
+                print("Connection failed: %s" % err)
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+        tinyg.close()
+
+def use_daemon(args):
+    """Returns the socket path to use for talking to a daemon, or None
+       if the daemon shouldn't be used.
+    """
+    if args.sim or args.no_daemon:
+        return None
+    return args.socket or default_socket_path(args.port)
+
+def read_board_config(tinyg, args, config):
+    """Reads the configuration from the TinyG into 'config', using a daemon
+       if one is running for the port. The show and dump commands will use
+       a cached configuration if the board hasn't changed since it was
+       cached (unless --refresh was given). Returns a list of the groups
+       which couldn't be read.
+    """
+    socket_path = use_daemon(args)
+    if socket_path:
+        response = daemon_request(socket_path, {'cmd' : args.cmd,
+                                                'refresh' : args.refresh})
+        if response is not None:
+            if args.verbose:
+                print("Using the daemon on '%s'" % socket_path)
+            config.add_group(response['config'])
+            return []
+    open_tinyg(tinyg, args, args.port)
+    cache = None if args.sim else ConfigCache(verbose=args.verbose)
+    if cache and args.cmd in ('dump', 'show') and not args.refresh:
+        try:
+            cached = cache.lookup(tinyg.read_group('sys', READ_RETRIES))
+        except TinyGTimeout:
+            # Fall back to reading everything.
+            cached = None
+        if cached:
+            config.add_group(cached.config)
+            return []
+    failed = tinyg.read_config(config)
+    if cache and not failed:
+        cache.store(config)
+    return failed
+
+def invalidate_cached_config(cache, tinyg, config):
+    """Discards the cached configuration of the board which 'config' was
+       written to (whether or not the write succeeded), since it's now out
+       of date. The board's id is taken from 'config', and from the board
+       itself if it can be read.
+    """
+    board_ids = set()
+    sys_group = config.get_group('sys')
+    if sys_group and 'id' in sys_group:
+        board_ids.add(sys_group['id'])
+    try:
+        sys_group = tinyg.read_group('sys')
+    except TinyGTimeout:
+        sys_group = None
+    if sys_group and 'id' in sys_group:
+        board_ids.add(sys_group['id'])
+    for board_id in board_ids:
+        cache.invalidate(board_id)
+
+def restore_board_config(tinyg, args, config):
+    """Writes 'config' to the TinyG, using a daemon if one is running for
+       the port. Returns a list of the (group_id, key) tuples which were
+       skipped by a differential restore.
+    """
+    checkpoint_path = None
+    if args.filename != '-':
+        checkpoint_path = default_checkpoint_path(args.filename)
+    socket_path = use_daemon(args)
+    if socket_path:
+        response = daemon_request(socket_path, {'cmd' : 'restore',
+                                                'config' : config.config,
+                                                'diff' : args.diff,
+                                                'verify' : args.verify,
+                                                'checkpoint' : checkpoint_path})
+        if response is not None:
+            if args.verbose:
+                print("Using the daemon on '%s'" % socket_path)
+            if args.verify:
+                report_mismatches(response.get('mismatches', ()))
+            return [tuple(entry) for entry in response.get('skipped', ())]
+    open_tinyg(tinyg, args, args.port)
+    checkpoint = None
+    if checkpoint_path:
+        checkpoint = RestoreCheckpoint(checkpoint_path)
+    skipped = []
+    written = config
+    try:
+        if args.diff:
+            (written, skipped) = tinyg.write_config_diff(config, checkpoint)[:2]
+        else:
+            tinyg.write_config(config, checkpoint)
+    finally:
+        if not args.sim:
+            invalidate_cached_config(ConfigCache(verbose=args.verbose), tinyg, config)
+    if args.verify:
+        # Only the items which were written need to be read back.
+        report_mismatches(tinyg.verify_config(written))
+    return skipped
+
+def report_mismatches(mismatches):
+    """Prints the mismatches found by TinyG.verify_config."""
+    for (group_id, key, expected, actual) in mismatches:
+        print("Verify failed: %s %s is %s (expected %s)" %
+              (group_id, key, '-' if actual is None else actual, expected))
+    if not mismatches:
+        print("Verified the restored configuration")
+
+def format_snapshot(entry):
+    """Returns a one line description of a snapshot's index entry."""
+    return '%s  %s  %s' % (entry['id'][:12],
+                           time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time'])),
+                           entry['board'])
+
+def run_store_command(args):
+    """Runs the history, diff, or import command against the archive store."""
+    store = ArchiveStore(args.store)
+    if args.cmd == 'history':
+        for entry in store.history(args.filename):
+            print(format_snapshot(entry))
+    elif args.cmd == 'diff':
+        if not args.filename or not args.extra:
+            print("diff command needs two snapshots to compare")
+            return
+        entry1 = store.find(args.filename)
+        entry2 = store.find(args.extra[0])
+        print('--- ' + format_snapshot(entry1))
+        print('+++ ' + format_snapshot(entry2))
+        for (group_id, key, val1, val2) in store.diff(entry1, entry2):
+            print('%-4s %-4s %12s -> %s' % (group_id, key,
+                                            '-' if val1 is None else val1,
+                                            '-' if val2 is None else val2))
+    elif args.cmd == 'import':
+        for filename in ([args.filename] if args.filename else []) + args.extra:
+            config = Config(verbose=args.verbose)
+            with open(filename, 'r') as file:
+                config.read(file)
+            entry = store.add(config, os.path.getmtime(filename))
+            print('%s  (%s)' % (format_snapshot(entry), filename))
+
+def read_config_file(config, filename):
+    """Reads the configuration file named by 'filename' into 'config'. A
+       filename of '-' reads from stdin.
+    """
+    if filename == '-':
+        config.read(sys.stdin)
+        return
+    with open(filename, 'r') as file:
+        config.read(file)
+
+def format_problem(group_id, key, message):
+    """Returns a one line description of a problem found by Config.validate."""
+    if key is None:
+        return '%s: %s' % (group_id, message)
+    return '%s %s: %s' % (group_id, key, message)
+
+def check_config(config, filename):
+    """Validates 'config' (read from filename) before it's written to a
+       TinyG, and prints any problems found. Returns True if the
+       configuration can be written.
+    """
+    (errors, warnings) = config.validate(strict=False)
+    for problem in warnings:
+        print("%s: warning: %s" % (filename, format_problem(*problem)))
+    for problem in errors:
+        print("%s: error: %s" % (filename, format_problem(*problem)))
+    if errors:
+        print("Not restoring %s, since it has %d error(s)" % (filename, len(errors)))
+    return not errors
+
+def lint_file(filename):
+    """Reads and validates a single configuration file. Returns a tuple
+       containing the filename and lists of errors and warnings (as
+       formatted strings). Called from the lint command's worker processes.
+    """
+    config = Config()
+    try:
+        with open(filename, 'r') as file:
+            config.read(file)
+    except (IOError, ValueError) as err:
+        return (filename, ["can't be read: %s" % err], [])
+    if not config.config:
+        return (filename, ["doesn't contain any configuration items"], [])
+    (errors, warnings) = config.validate()
+    return (filename,
+            [format_problem(*problem) for problem in errors],
+            [format_problem(*problem) for problem in warnings])
+
+def expand_lint_files(names):
+    """Returns the files to check for the lint command. Directories are
+       searched (recursively) for .config files.
+    """
+    filenames = []
+    for name in names:
+        if not os.path.isdir(name):
+            filenames.append(name)
+            continue
+        for (dirpath, dirnames, files) in os.walk(name):
+            dirnames.sort()
+            filenames.extend(os.path.join(dirpath, filename)
+                             for filename in sorted(files)
+                             if filename.endswith('.config'))
+    return filenames
+
+def run_lint(args, names):
+    """Checks the configuration files and directories given by 'names',
+       using a process per CPU. Returns the number of files with errors.
+    """
+    filenames = expand_lint_files(names)
+    if len(filenames) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool()
+        try:
+            results = list(pool.imap(lint_file, filenames, LINT_CHUNK_SIZE))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [lint_file(filename) for filename in filenames]
+    failed = 0
+    for (filename, errors, warnings) in results:
+        for problem in warnings:
+            print("%s: warning: %s" % (filename, problem))
+        for problem in errors:
+            print("%s: error: %s" % (filename, problem))
+        if errors:
+            failed += 1
+        elif args.verbose:
+            print("%s: ok" % filename)
+    print("%d of %d file(s) have errors" % (failed, len(results)))
+    return failed
+
+def run_monitor(tinyg, args, filename):
+    """Records the status and queue reports from the TinyG into filename,
+       until args.duration seconds have passed (or forever if it's zero),
+       or the program is interrupted.
+    """
+    with open(filename, 'w') as file:
+        recorder = TelemetryRecorder(file, every=args.every,
+                                     min_interval=args.min_interval)
+        open_tinyg(tinyg, args, args.port)
+        tinyg.subscribe(recorder.record)
+        # Start with a complete status report.
+        response = tinyg.request({'sr' : None})
+        if isinstance(response, dict) and 'sr' in response:
+            recorder.record('sr', response['sr'])
+        end_time = time.time() + args.duration if args.duration else None
+        try:
+            while end_time is None or time.time() < end_time:
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            tinyg.unsubscribe(recorder.record)
+            tinyg.close()
+            recorder.flush()
+    print("Recorded %d report(s) into %s (%d skipped by downsampling)" %
+          (recorder.recorded, filename, recorder.skipped))
+
+def run_stream(tinyg, args, filename):
+    """Streams the gcode in filename to the TinyG."""
+    open_tinyg(tinyg, args, args.port)
+    streamer = GcodeStreamer(tinyg)
+    start = time.time()
+    try:
+        with open(filename, 'r') as file:
+            streamer.stream(gcode_lines(file))
+    except TinyGTimeout as err:
+        print(err)
+        print("Streaming stopped after sending %d line(s)" % streamer.lines_sent)
+        sys.exit(1)
+    print("Sent %d line(s) in %.1f seconds" % (streamer.lines_sent, time.time() - start))
+    if streamer.errors:
+        print("%d line(s) were skipped or rejected" % streamer.errors)
+        sys.exit(1)
+
+def want_stats(args):
+    """Returns True if the command line asked for statistics."""
+    return args.stats or args.stats_json
+
+def report_stats(args, stats):
+    """Prints and/or saves the statistics, as requested by the command line."""
+    if args.stats:
+        print(stats.summary())
+    if args.stats_json:
+        with open(args.stats_json, 'w') as file:
+            json.dump(stats.to_dict(), file, indent=2, sort_keys=True)
+            file.write('\n')
+
+def expand_ports(port_spec):
+    """Expands a comma separated list of port names, each of which may
+       contain glob style wildcards, into a list of port names.
+    """
+    import glob
+    ports = []
+    for pattern in port_spec.split(','):
+        if not pattern:
+            continue
+        matches = sorted(glob.glob(pattern))
+        if matches:
+            ports.extend(matches)
+        elif not glob.has_magic(pattern):
+            # Let the open report that the port doesn't exist.
+            ports.append(pattern)
+    return ports
+
+
+class FleetJob(object):
+    """Runs a single command against one board of a fleet. Each job runs
+       in its own thread, and any error is caught and recorded so that it
+       doesn't affect the jobs running against the other boards.
+    """
+
+    def __init__(self, args, cmd, port, config, filename):
+        self.args = args
+        self.cmd = cmd
+        self.port = port
+        self.config = config
+        self.filename = filename
+        self.result = None
+        self.error = None
+        self.stats = Stats() if want_stats(args) else None
+        self.thread = threading.Thread(target=self.run, name=port)
+        # Don't let a hung board prevent the program from exiting.
+        self.thread.daemon = True
+
+    def run(self):
+        """Runs the command. Called from the job's thread."""
+        tinyg = TinyG(verbose=self.args.verbose, pipeline=self.args.pipeline,
+                      combine_groups=self.args.combine_groups, stats=self.stats,
+                      name=self.port)
+        try:
+            open_tinyg(tinyg, self.args, self.port)
+            if self.cmd == 'restore':
+                try:
+                    if self.args.diff:
+                        (_, skipped, failed) = tinyg.write_config_diff(self.config)
+                        result = "restored (skipped %d item(s) which were already set)" % len(skipped)
+                    else:
+                        failed = tinyg.write_config(self.config)
+                        result = "restored"
+                finally:
+                    if not self.args.sim:
+                        invalidate_cached_config(ConfigCache(verbose=self.args.verbose),
+                                                 tinyg, self.config)
+                if failed:
+                    self.error = "write of group config '%s' failed" % "', '".join(failed)
+                else:
+                    self.result = result
+            else:
+                failed = tinyg.read_config(self.config)
+                if failed:
+                    # Don't archive a partial configuration.
+                    self.error = "read of group config '%s' failed" % "', '".join(failed)
+                elif self.cmd == 'archive':
+                    with open(self.filename, 'w') as file:
+                        self.config.write(file)
+                    self.result = "archived into %s" % self.filename
+                else:
+                    self.result = "read"
+        except Exception as err:
+            self.error = str(err) or err.__class__.__name__
+        finally:
+            tinyg.close()
+
+
+def run_fleet(args, cmd, filename):
+    """Runs the archive, restore, or show command against each of the
+       boards given by the --port option concurrently. For archive, filename
+       is an optional directory to store the archives in. For restore,
+       filename is the configuration file to send to every board.
+    """
+    if cmd not in ('archive', 'restore', 'show'):
+        print("fleet command needs one of archive, restore, or show")
+        return
+    ports = expand_ports(args.port)
+    if not ports:
+        print("No ports match '%s'" % args.port)
+        return
+    if cmd == 'restore':
+        if not filename:
+            print("fleet restore needs the name of a file to read the configuration from")
+            return
+        restore_config = Config(verbose=args.verbose)
+        with open(filename, 'r') as file:
+            restore_config.read(file)
+        if not check_config(restore_config, filename):
+            return
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+    jobs = []
+    for port in ports:
+        if cmd == 'restore':
+            config = restore_config
+            job_filename = filename
+        else:
+            config = Config(verbose=args.verbose)
+            job_filename = os.path.join(filename or '', 'TinyG-%s-%s.config' %
+                                        (os.path.basename(port), timestamp))
+        jobs.append(FleetJob(args, cmd, port, config, job_filename))
+    for job in jobs:
+        job.thread.start()
+    deadline = time.time() + args.timeout
+    for job in jobs:
+        job.thread.join(max(0, deadline - time.time()))
+    failed = 0
+    for job in jobs:
+        if job.thread.is_alive():
+            print("%s: timed out after %d seconds" % (job.port, args.timeout))
+            failed += 1
+        elif job.error:
+            print("%s: failed: %s" % (job.port, job.error))
+            failed += 1
+        else:
+            print("%s: %s" % (job.port, job.result))
+            if cmd == 'show':
+                job.config.dump_formatted()
+    print("%d of %d board(s) succeeded" % (len(jobs) - failed, len(jobs)))
+    if want_stats(args):
+        stats = Stats()
+        for job in jobs:
+            if not job.thread.is_alive():
+                stats.merge(job.stats)
+        report_stats(args, stats)
 
 
 def main():
     """The main program."""
+    import argparse
+    from argparse import RawDescriptionHelpFormatter
     default_baud = 115200
     default_port = '/dev/ttyUSB0'
+    default_timeout = 120
+    default_store = os.path.expanduser('~/.tinyg-archive')
     parser = argparse.ArgumentParser(
-        usage="%(prog)s [options] command [filename]",
+        usage="%(prog)s [options] command [filename] [args ...]",
         description="Archives, restores, or shows the TinyG configuration\n"
         "  archive - retrieves the configuration from the TinyG and stores it in a file\n"
         "  restore - reads a configuration file and writes it to the TinyG\n"
-        "  show    - displays the TinyG configuration, or the configuration from a file",
+        "  show    - displays the TinyG configuration, or the configuration from a file\n"
+        "  fleet   - runs archive, restore, or show against all of the ports given by -p\n"
+        "  daemon  - keeps the TinyG open and serves requests from other invocations\n"
+        "  history - lists the snapshots in the archive store\n"
+        "  diff    - compares two snapshots from the archive store\n"
+        "  import  - adds configuration files to the archive store\n"
+        "  compare - compares several configuration files side by side\n"
+        "  lint    - checks configuration files (or directories of them) for errors\n"
+        "  monitor - records status and queue reports from the TinyG into a file\n"
+        "  stream  - sends a gcode file to the TinyG",
         formatter_class=RawDescriptionHelpFormatter
     )
     parser.add_argument(
@@ -459,9 +2560,126 @@ def main():
         dest="port",
         action="store",
         type=str,
-        help="Set the port used (default = %s)" % default_port,
+        help="Set the port used (default = %s). For the fleet command this "
+        "may be a comma separated list of ports or glob patterns" % default_port,
         default=default_port
     )
+    parser.add_argument(
+        "--duration",
+        dest="duration",
+        action="store",
+        type=float,
+        help="Seconds to run the monitor command for (default = until interrupted)",
+        default=0
+    )
+    parser.add_argument(
+        "--every",
+        dest="every",
+        action="store",
+        type=int,
+        help="Only record every EVERY'th report of each kind (default = 1)",
+        default=1
+    )
+    parser.add_argument(
+        "--min-interval",
+        dest="min_interval",
+        action="store",
+        type=float,
+        help="Minimum seconds between recorded reports of each kind (default = 0)",
+        default=0
+    )
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="Don't read back the configuration after restoring it",
+        default=True
+    )
+    parser.add_argument(
+        "--no-daemon",
+        dest="no_daemon",
+        action="store_true",
+        help="Talk to the TinyG directly, even if a daemon is running",
+        default=False
+    )
+    parser.add_argument(
+        "--socket",
+        dest="socket",
+        action="store",
+        type=str,
+        help="Unix socket used to talk to the daemon (default = /tmp/tinyg-PORT.sock)",
+        default=None
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        action="store",
+        type=str,
+        help="Archive store used by the archive, diff, history, and import "
+        "commands (default = %s)" % default_store,
+        default=None
+    )
+    parser.add_argument(
+        "--refresh",
+        dest="refresh",
+        action="store_true",
+        help="Read the whole configuration from the TinyG, rather than using a cached "
+        "copy. The cached copy is only checked against the sys group, so use this "
+        "after changing the configuration with another program",
+        default=False
+    )
+    parser.add_argument(
+        "--sim",
+        dest="sim",
+        action="store",
+        type=str,
+        help="Talk to a simulated TinyG whose configuration is read from SIM",
+        default=None
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        help="Print statistics about the traffic to and from the TinyG",
+        default=False
+    )
+    parser.add_argument(
+        "--stats-json",
+        dest="stats_json",
+        action="store",
+        type=str,
+        help="Write statistics about the traffic to and from the TinyG to STATS_JSON",
+        default=None
+    )
+    parser.add_argument(
+        "-t", "--timeout",
+        dest="timeout",
+        action="store",
+        type=float,
+        help="Seconds to wait for all of the boards in fleet mode (default = %d)" % default_timeout,
+        default=default_timeout
+    )
+    parser.add_argument(
+        "-d", "--diff",
+        dest="diff",
+        action="store_true",
+        help="Only restore the items which differ from the TinyG",
+        default=False
+    )
+    parser.add_argument(
+        "-G", "--combine-groups",
+        dest="combine_groups",
+        action="store_true",
+        help="Allow several groups to be written using a single command",
+        default=False
+    )
+    parser.add_argument(
+        "-P", "--pipeline",
+        dest="pipeline",
+        action="store_true",
+        help="Keep several requests in flight when reading the configuration",
+        default=False
+    )
     parser.add_argument(
         "-v", "--verbose",
         dest="verbose",
@@ -478,6 +2696,11 @@ def main():
         nargs="?",
         help="Filename to use (optional for show command)"
     )
+    parser.add_argument(
+        "extra",
+        nargs="*",
+        help="Additional arguments (used by the fleet, diff, import, compare, and lint commands)"
+    )
     args = parser.parse_args(sys.argv[1:])
     if args.verbose:
         print("baud port: %s" % args.port)
@@ -487,27 +2710,55 @@ def main():
             print("filename = '%s'" % args.filename)
 
     config = Config(verbose=args.verbose)
-    tinyg = TinyG(verbose=args.verbose)
+    store_given = args.store is not None
+    if not store_given:
+        args.store = default_store
+    # The fleet command collects its own statistics for each board.
+    stats = Stats() if want_stats(args) and args.cmd != 'fleet' else None
+    tinyg = TinyG(verbose=args.verbose, pipeline=args.pipeline,
+                  combine_groups=args.combine_groups, stats=stats)
+    try:
+        run_command(tinyg, args, config, store_given)
+    except TinyGTimeout as err:
+        print(err)
+        if args.cmd == 'restore':
+            print("Restore stopped. Run the same restore again to resume it.")
+        sys.exit(1)
+
+    if stats:
+        tinyg.close()
+        report_stats(args, stats)
 
+
+def run_command(tinyg, args, config, store_given):
+    """Runs the command given on the command line."""
     if args.cmd == 'archive':
 
         filename = args.filename
-        if not filename:
+        if not filename and not store_given:
             filename = time.strftime('TinyG-%Y%m%d-%H%M%S.config')
             print("Writing TinyG configuration into", filename)
-        tinyg.open_serial(args.port, args.baud)
-        tinyg.read_config(config)
-        with open(filename, 'w') as file:
-            config.write(file)
+        if read_board_config(tinyg, args, config):
+            # Don't archive a partial configuration.
+            print("Not archiving, since the configuration couldn't all be read")
+            sys.exit(1)
+        if filename:
+            with open(filename, 'w') as file:
+                config.write(file)
+        if store_given:
+            entry = ArchiveStore(args.store).add(config)
+            print("Stored snapshot", format_snapshot(entry))
+
+    elif args.cmd == 'daemon':
+
+        run_daemon(tinyg, args, args.socket or default_socket_path(args.port))
 
     elif args.cmd == 'dump':
 
         if args.filename:
-            with open(args.filename, 'r') as file:
-                config.read(file)
+            read_config_file(config, args.filename)
         else:
-            tinyg.open_serial(args.port, args.baud)
-            tinyg.read_config(config)
+            read_board_config(tinyg, args, config)
         config.dump()
 
     elif args.cmd == 'restore':
@@ -516,24 +2767,72 @@ def main():
             print("restore command needs the name of a file to read the configuration from")
             return
 
-        with open(args.filename, 'r') as file:
-            config.read(file)
-        tinyg.open_serial(args.port, args.baud)
-        tinyg.write_config(config)
+        read_config_file(config, args.filename)
+        if not check_config(config, args.filename):
+            return
+        skipped = restore_board_config(tinyg, args, config)
+        if args.diff:
+            print("Skipped %d item(s) which were already set" % len(skipped))
+            if args.verbose:
+                for (group_id, key) in sorted(skipped):
+                    print("  Skipped %s %s" % (group_id, key))
 
     elif args.cmd == 'show':
 
         if args.filename:
-            with open(args.filename, 'r') as file:
-                config.read(file)
+            read_config_file(config, args.filename)
         else:
-            tinyg.open_serial(args.port, args.baud)
-            tinyg.read_config(config)
+            read_board_config(tinyg, args, config)
         config.dump_formatted()
 
+    elif args.cmd in ('diff', 'history', 'import'):
+
+        run_store_command(args)
+
+    elif args.cmd == 'compare':
+
+        filenames = ([args.filename] if args.filename else []) + args.extra
+        if len(filenames) < 2:
+            print("compare command needs at least two files to compare")
+            return
+        configs = []
+        for filename in filenames:
+            file_config = Config(verbose=args.verbose)
+            with open(filename, 'r') as file:
+                file_config.read(file)
+            configs.append(file_config)
+        names = [os.path.splitext(os.path.basename(filename))[0] for filename in filenames]
+        ConfigTable(names, configs).dump()
+
+    elif args.cmd == 'lint':
+
+        names = ([args.filename] if args.filename else []) + args.extra
+        if not names:
+            print("lint command needs the configuration files or directories to check")
+            return
+        if run_lint(args, names):
+            sys.exit(1)
+
+    elif args.cmd == 'monitor':
+
+        filename = args.filename
+        if not filename:
+            filename = time.strftime('TinyG-%Y%m%d-%H%M%S.telemetry')
+        run_monitor(tinyg, args, filename)
+
+    elif args.cmd == 'stream':
+
+        if not args.filename:
+            print("stream command needs the name of a gcode file to send")
+            return
+        run_stream(tinyg, args, args.filename)
+
+    elif args.cmd == 'fleet':
+
+        run_fleet(args, args.filename, args.extra[0] if args.extra else None)
+
     else:
         print("Unrecognied command '%s'" % args.cmd)
-        return
 
 
 if __name__ == "__main__":
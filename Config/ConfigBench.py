@@ -0,0 +1,248 @@
+#!/usr/bin/python -u
+
+"""Benchmarks for the parsing, formatting, and protocol code in Config.py.
+
+Each benchmark is run several times, and the minimum, median, and mean times
+are reported. Results can also be written to a JSON file so that they can be
+compared from one run to the next.
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from Config import Config, TinyG
+from TinyGSim import SimBus
+
+SAMPLE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_JSON = os.path.join(SAMPLE_DIR, 'TinyG-20150423-135312.config')
+SAMPLE_TEXT = os.path.join(SAMPLE_DIR, 'TinyG-20150423-135312.config.show')
+
+# Number of $$ dumps in the synthetic capture used by read_text_large.
+LARGE_CAPTURE_DUMPS = 200
+
+CONFIG_PY = os.path.join(SAMPLE_DIR, 'Config.py')
+
+# Startup benchmarks which take longer than this many seconds are flagged as
+# being over budget.
+STARTUP_BUDGET = 0.15
+
+# (baud, latency) combinations used for the protocol benchmarks.
+PROTOCOL_LINKS = (
+    (9600, 0.0),
+    (115200, 0.0),
+    (115200, 0.005),
+)
+
+
+def read_file(filename):
+    """Returns the contents of filename as a string."""
+    with open(filename, 'r') as file:
+        return file.read()
+
+
+def load_config(text):
+    """Returns a Config parsed from 'text'."""
+    config = Config()
+    config.read(io.StringIO(text))
+    return config
+
+
+class Benchmark(object):
+    """A single benchmark. 'func' is called once per run, and 'setup'
+       (if given) is called before each run, outside of the timing.
+    """
+
+    def __init__(self, name, func, setup=None, params=None):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.params = params or {}
+
+    def run(self, runs):
+        """Runs the benchmark and returns a dictionary of results."""
+        times = []
+        for _ in range(runs):
+            if self.setup:
+                self.setup()
+            start = time.time()
+            self.func()
+            times.append(time.time() - start)
+        times.sort()
+        return {
+            'name' : self.name,
+            'params' : self.params,
+            'runs' : runs,
+            'min' : times[0],
+            'median' : times[len(times) // 2],
+            'mean' : sum(times) / len(times),
+        }
+
+
+def parsing_benchmarks():
+    """Returns the benchmarks for reading, formatting and writing configs."""
+    json_text = read_file(SAMPLE_JSON)
+    show_text = read_file(SAMPLE_TEXT)
+    large_text = show_text * LARGE_CAPTURE_DUMPS
+    config = load_config(json_text)
+
+    return [
+        Benchmark('read_json', lambda: load_config(json_text)),
+        Benchmark('read_text', lambda: load_config(show_text)),
+        Benchmark('read_text_large', lambda: load_config(large_text),
+                  params={'dumps' : LARGE_CAPTURE_DUMPS}),
+        Benchmark('dump_formatted', lambda: config.dump_formatted(io.StringIO())),
+        Benchmark('write', lambda: config.write(io.StringIO())),
+    ]
+
+
+class ProtocolBench(object):
+    """Holds a TinyG talking to a freshly simulated board, for the
+       read_config and write_config benchmarks.
+    """
+
+    def __init__(self, baud, latency, pipeline):
+        self.json_text = read_file(SAMPLE_JSON)
+        self.config = load_config(self.json_text)
+        self.baud = baud
+        self.latency = latency
+        self.pipeline = pipeline
+        self.tinyg = None
+
+    def setup(self):
+        """Connects to a new simulated board."""
+        if self.tinyg:
+            self.tinyg.close()
+        self.tinyg = TinyG(pipeline=self.pipeline)
+        self.tinyg.open_bus(SimBus(load_config(self.json_text),
+                                   baud=self.baud, latency=self.latency))
+
+    def read_config(self):
+        self.tinyg.read_config(Config())
+
+    def write_config(self):
+        self.tinyg.write_config(self.config)
+
+
+def protocol_benchmarks():
+    """Returns the benchmarks which talk to a simulated board."""
+    benchmarks = []
+    for baud, latency in PROTOCOL_LINKS:
+        for pipeline in (False, True):
+            params = {'baud' : baud, 'latency' : latency, 'pipeline' : pipeline}
+            bench = ProtocolBench(baud, latency, pipeline)
+            benchmarks.append(Benchmark('read_config', bench.read_config,
+                                        setup=bench.setup, params=params))
+            benchmarks.append(Benchmark('write_config', bench.write_config,
+                                        setup=bench.setup, params=params))
+    return benchmarks
+
+
+def run_python(*args):
+    """Runs python in a new process, with its output discarded."""
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call((sys.executable,) + args,
+                              cwd=SAMPLE_DIR, stdout=devnull)
+
+
+def startup_benchmarks():
+    """Returns the benchmarks which time starting a new process, which
+       includes the time taken to start the interpreter itself.
+    """
+    params = {'budget' : STARTUP_BUDGET}
+    return [
+        Benchmark('startup_import', lambda: run_python('-c', 'import Config'),
+                  params=params),
+        Benchmark('startup_show', lambda: run_python(CONFIG_PY, 'show', SAMPLE_JSON),
+                  params=params),
+    ]
+
+
+def format_params(params):
+    """Formats a params dictionary for display."""
+    return ' '.join('%s=%s' % (key, params[key]) for key in sorted(params))
+
+
+def main():
+    """The main program."""
+    parser = argparse.ArgumentParser(
+        description="Runs the Config.py benchmarks"
+    )
+    parser.add_argument(
+        "-n", "--runs",
+        dest="runs",
+        action="store",
+        type=int,
+        help="Number of times to run each benchmark (default = 5)",
+        default=5
+    )
+    parser.add_argument(
+        "-j", "--json",
+        dest="json",
+        action="store",
+        type=str,
+        help="Write the results to JSON",
+        default=None
+    )
+    parser.add_argument(
+        "--no-protocol",
+        dest="protocol",
+        action="store_false",
+        help="Skip the benchmarks which talk to a simulated board",
+        default=True
+    )
+    parser.add_argument(
+        "--no-startup",
+        dest="startup",
+        action="store_false",
+        help="Skip the benchmarks which time starting a new process",
+        default=True
+    )
+    parser.add_argument(
+        "filter",
+        nargs="*",
+        help="Only run the benchmarks whose names contain one of these strings"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    benchmarks = parsing_benchmarks()
+    if args.protocol:
+        benchmarks += protocol_benchmarks()
+    if args.startup:
+        benchmarks += startup_benchmarks()
+    if args.filter:
+        benchmarks = [bench for bench in benchmarks
+                      if any(name in bench.name for name in args.filter)]
+
+    results = []
+    for bench in benchmarks:
+        result = bench.run(args.runs)
+        results.append(result)
+        print('%-16s %10.3f ms %10.3f ms  %s' % (result['name'],
+                                                 result['min'] * 1000,
+                                                 result['median'] * 1000,
+                                                 format_params(result['params'])))
+        budget = result['params'].get('budget')
+        if budget is not None and result['min'] > budget:
+            print('%-16s over the startup budget of %.0f ms' % (result['name'],
+                                                                budget * 1000))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({
+                'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python' : platform.python_version(),
+                'platform' : platform.platform(),
+                'results' : results,
+            }, file, indent=2, sort_keys=True)
+            file.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Module which simulates a TinyG board.
+
+The simulation runs in-process, and is used in place of a serial port by
+passing a SimBus object to TinyG.open_bus(). It answers configuration queries
+and writes from a Config object, and models the time taken to move each line
+over the wire, the time taken for the board to respond, lost lines, and the
+status reports which a real board sends while it's idle.
+"""
+
+from __future__ import print_function
+
+import heapq
+import json
+import random
+import threading
+import time
+
+from Config import Bus, CONFIG_READ_ONLY, GROUP_STRS, KEY_INDEX, \
+                   RX_BUFFER_SIZE, STAT_OK, to_json
+
+# Number of moves which the simulated motion planner can hold.
+PLANNER_BUFFERS = 28
+
+# TinyG status codes used in the footer of a response (see also STAT_OK).
+STAT_UNRECOGNIZED_NAME = 100
+
+
+class SimBus(Bus):
+    """Bus which talks to a simulated TinyG whose configuration is held in
+       'config' (a Config object). Writes made to the simulated board are
+       stored back into 'config'.
+
+       baud        - rate used to pace lines in each direction (10 bits/char)
+       latency     - seconds between a line arriving and its response starting
+       drop_rate   - probability (0..1) that a line is lost on the way in
+       sr_interval - seconds between status reports (None for no reports)
+       timeout     - seconds that readline waits before giving up
+       move_time   - seconds that each line of gcode takes to execute
+
+       Lines of gcode are queued in a simulated motion planner. When the
+       planner is full, the board stops processing lines (and responding)
+       until a move completes. If the queue report verbosity [qv] is set, a
+       queue report is sent each time a move is queued or completes.
+    """
+
+    def __init__(self, config, baud=115200, latency=0.0, drop_rate=0.0,
+                 sr_interval=None, timeout=1.0, seed=None, move_time=0.0):
+        self.config = config
+        self.char_time = 10.0 / baud
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.sr_interval = sr_interval
+        self.timeout = timeout
+        self.move_time = move_time
+        self.random = random.Random(seed)
+        self.cond = threading.Condition()
+        self.partial = b''
+        self.tx_free = 0    # Time when the host to board direction is free
+        self.rx_free = 0    # Time when the board to host direction is free
+        self.rx_lines = []  # (processed_time, bytes) of lines in the board
+        self.output = []    # heap of (ready_time, seq, line)
+        self.seq = 0
+        self.closed = False
+        self.last_processed = 0
+        self.moves = []     # completion times of the moves in the planner
+        self.move_reports = []  # completion times still to be reported
+        self.next_sr = time.time() + sr_interval if sr_interval else None
+        self.position = {'posx' : 0.0, 'posy' : 0.0, 'posz' : 0.0, 'posa' : 0.0}
+
+    def write(self, data):
+        with self.cond:
+            self.partial += data
+            while b'\n' in self.partial:
+                line, self.partial = self.partial.split(b'\n', 1)
+                self.receive_line(line.decode('ascii').strip())
+            self.cond.notify_all()
+
+    def readline(self, size):
+        deadline = time.time() + self.timeout
+        with self.cond:
+            while True:
+                if self.closed:
+                    return b''
+                now = time.time()
+                self.queue_status_reports(now)
+                self.queue_move_reports(now)
+                if self.output and self.output[0][0] <= now:
+                    line = heapq.heappop(self.output)[2]
+                    return line[:size]
+                if now >= deadline:
+                    return b''
+                wake = deadline
+                if self.output:
+                    wake = min(wake, self.output[0][0])
+                if self.next_sr is not None:
+                    wake = min(wake, self.next_sr)
+                if self.move_reports:
+                    wake = min(wake, self.move_reports[0])
+                self.cond.wait(max(0, wake - now))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def receive_line(self, line):
+        """Called when the host sends a line. Works out when the line
+           arrives and is processed, and queues up the response.
+        """
+        now = time.time()
+        line_bytes = len(line) + 1
+        arrived = max(now, self.tx_free) + line_bytes * self.char_time
+        self.tx_free = arrived
+        # Lines are processed one at a time, in the order they arrive.
+        processed = max(arrived + self.latency, self.last_processed)
+        # Lines sit in the receive buffer until they've been processed. If
+        # there isn't room for this one, then it gets lost, just like on a
+        # real board.
+        self.rx_lines = [entry for entry in self.rx_lines if entry[0] > arrived]
+        buffered = sum(entry[1] for entry in self.rx_lines)
+        if buffered + line_bytes > RX_BUFFER_SIZE:
+            return
+        if self.random.random() < self.drop_rate:
+            return
+        response = self.process_line(line)
+        if response is None:
+            # A line of gcode, which needs room in the planner.
+            processed = self.plan_move(processed)
+            response = {'r' : {}, 'f' : [1, self.gcode_status(line), line_bytes]}
+            if (self.config.get_group('sys') or {}).get('qv'):
+                self.queue_line(processed, to_json({'qr' : self.planner_free(processed)}))
+        self.last_processed = processed
+        self.rx_lines.append((processed, line_bytes))
+        self.queue_line(processed, to_json(response))
+
+    def plan_move(self, start):
+        """Queues a move in the planner, waiting (from time 'start') for a
+           free buffer if necessary. Returns the time that the move was
+           queued.
+        """
+        self.moves = [done for done in self.moves if done > start]
+        if len(self.moves) >= PLANNER_BUFFERS:
+            start = self.moves.pop(0)
+        previous = self.moves[-1] if self.moves else start
+        done = max(start, previous) + self.move_time
+        self.moves.append(done)
+        if (self.config.get_group('sys') or {}).get('qv'):
+            self.move_reports.append(done)
+        return start
+
+    def gcode_status(self, line):
+        """Returns the status code for a line of gcode. The simulation
+           accepts every line.
+        """
+        return STAT_OK
+
+    def planner_free(self, now):
+        """Returns the number of free planner buffers at time 'now'."""
+        return PLANNER_BUFFERS - len([done for done in self.moves if done > now])
+
+    def queue_line(self, start, line):
+        """Queues up 'line' to be sent to the host, starting no earlier
+           than 'start'.
+        """
+        data = line.encode('ascii') + b'\n'
+        ready = max(start, self.rx_free) + len(data) * self.char_time
+        self.rx_free = ready
+        heapq.heappush(self.output, (ready, self.seq, data))
+        self.seq += 1
+
+    def queue_status_reports(self, now):
+        """Queues up any status reports which are due by 'now'."""
+        while self.next_sr is not None and self.next_sr <= now:
+            self.queue_line(self.next_sr, to_json({'sr' : self.status_report()}))
+            self.next_sr += self.sr_interval
+
+    def queue_move_reports(self, now):
+        """Queues up a queue report for each move completed by 'now'."""
+        while self.move_reports and self.move_reports[0] <= now:
+            done = self.move_reports.pop(0)
+            self.queue_line(done, to_json({'qr' : self.planner_free(done)}))
+
+    def status_report(self):
+        """Returns the contents of a status report."""
+        report = dict(self.position)
+        report['vel'] = 0
+        report['stat'] = 3
+        return report
+
+    def process_line(self, line):
+        """Processes a line sent by the host and returns the response
+           dictionary, or None for a line of gcode.
+        """
+        try:
+            cmd = json.loads(line)
+        except ValueError:
+            cmd = None
+        if not isinstance(cmd, dict):
+            # Anything which isn't JSON is treated as a line of gcode, which
+            # receive_line handles.
+            return None
+        status = STAT_OK
+        r = {}
+        for name, val in cmd.items():
+            if name in GROUP_STRS:
+                r[name] = self.process_group(name, val)
+            elif name in KEY_INDEX:
+                (group_id, key) = KEY_INDEX[name][:2]
+                r[name] = self.process_key(group_id, key, val)
+            elif name == 'gc':
+                r[name] = val
+            elif name == 'sr':
+                r[name] = self.status_report()
+            else:
+                status = STAT_UNRECOGNIZED_NAME
+        return {'r' : r, 'f' : [1, status, len(line) + 1]}
+
+    def process_group(self, group_id, val):
+        """Handles a request for a group. A value of None queries the
+           entire group, otherwise val is a dictionary of keys to query
+           (value None) or set.
+        """
+        if val is None:
+            return self.config.get_group(group_id) or {}
+        result = {}
+        for key in val:
+            result[key] = self.process_key(group_id, key, val[key])
+        return result
+
+    def process_key(self, group_id, key, val):
+        """Queries (val is None) or sets a single configuration item and
+           returns its value.
+        """
+        group = self.config.get_group(group_id) or {}
+        if val is not None and val != '' and \
+                key not in CONFIG_READ_ONLY.get(group_id, ()):
+            self.config.add_group({group_id : {key : val}})
+            return val
+        return group.get(key)
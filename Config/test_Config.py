@@ -0,0 +1,457 @@
+"""Tests for Config.py, which talk to a simulated TinyG (see TinyGSim.py).
+
+Run them using: python -m pytest (or python -m unittest test_Config)
+"""
+
+import copy
+import heapq
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from Config import CompactConfig, Config, ConfigCache, ConfigDaemon, GcodeStreamer, \
+                   RestoreCheckpoint, Stats, TinyG, TinyGTimeout, CONFIG_MAP, \
+                   CONFIG_READ_ONLY, MAX_LINE_LEN, TextParser, lint_file, to_json, pack_commands, parse_choices
+from TinyGSim import SimBus
+
+SAMPLE_SHOW = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'TinyG-20150423-135312.config.show')
+SAMPLE_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'TinyG-20150423-135312.config')
+
+# Seconds that TinyG waits for each response in these tests. The late
+# response arrives after LATE_DELAY, long after the TinyG has given up on it.
+RESPONSE_TIMEOUT = 0.2
+LATE_DELAY = 0.5
+
+
+def load_sample():
+    """Returns a Config containing the sample configuration."""
+    config = Config()
+    with open(SAMPLE_JSON, 'r') as file:
+        config.read(file)
+    return config
+
+
+def pack_items(config):
+    """Returns the (group_id, key) tuples which restoring 'config' writes."""
+    return [(group_id, key) for cmd in pack_commands(config)
+            for group_id in cmd for key in cmd[group_id]]
+
+
+def open_tinyg(test, bus, **kwargs):
+    """Returns a TinyG talking to 'bus', which is closed when 'test'
+       finishes. kwargs are passed on to TinyG.
+    """
+    tinyg = TinyG(**kwargs)
+    tinyg.response_timeout = RESPONSE_TIMEOUT
+    tinyg.open_bus(bus)
+    test.addCleanup(tinyg.close)
+    return tinyg
+
+
+class LateSimBus(SimBus):
+    """SimBus which delays the first response line starting with 'prefix'
+       by 'delay' seconds, without holding up the lines after it.
+    """
+
+    def __init__(self, config, prefix, delay=LATE_DELAY, **kwargs):
+        SimBus.__init__(self, config, **kwargs)
+        self.prefix = prefix
+        self.delay = delay
+        self.delayed = False
+
+    def queue_line(self, start, line):
+        if self.delayed or not line.startswith(self.prefix):
+            SimBus.queue_line(self, start, line)
+            return
+        self.delayed = True
+        data = line.encode('ascii') + b'\n'
+        heapq.heappush(self.output, (start + self.delay, self.seq, data))
+        self.seq += 1
+
+
+def make_config(group_dict):
+    """Returns a Config holding the groups in group_dict."""
+    config = Config()
+    config.add_group(group_dict)
+    return config
+
+
+class DeafSimBus(SimBus):
+    """SimBus which loses every line starting with 'prefix'."""
+
+    def __init__(self, config, prefix, **kwargs):
+        SimBus.__init__(self, config, **kwargs)
+        self.prefix = prefix
+
+    def receive_line(self, line):
+        if not line.startswith(self.prefix):
+            SimBus.receive_line(self, line)
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_read_only_items_are_not_skipped(self):
+        config = load_sample()
+        (changed, same) = config.diff(load_sample())
+        self.assertEqual(changed.config, {})
+        self.assertEqual(len(same), len(pack_items(config)))
+        self.assertNotIn(('sys', 'fb'), same)
+
+
+class PackTest(unittest.TestCase):
+
+    def check_pack(self, config, combine_groups):
+        cmds = pack_commands(config, combine_groups)
+        for cmd in cmds:
+            self.assertLessEqual(len(to_json(cmd)) + 1, MAX_LINE_LEN)
+            if not combine_groups:
+                self.assertEqual(len(cmd), 1)
+        packed = [(group_id, key) for cmd in cmds
+                  for group_id in cmd for key in cmd[group_id]]
+        writable = [(group_id, key) for group_id, group in config.config.items()
+                    for key in group
+                    if key not in CONFIG_READ_ONLY.get(group_id, ())]
+        self.assertEqual(len(packed), len(set(packed)))
+        self.assertEqual(sorted(packed), sorted(writable))
+        return cmds
+
+    def test_sample(self):
+        config = load_sample()
+        separate = self.check_pack(config, combine_groups=False)
+        combined = self.check_pack(config, combine_groups=True)
+        self.assertLess(len(combined), len(separate))
+
+    def test_long_values(self):
+        config = load_sample()
+        for group in config.config.values():
+            for key in group:
+                group[key] = 123456789.12345678
+        for combine_groups in (False, True):
+            cmds = self.check_pack(config, combine_groups)
+            # The system group no longer fits in a single command.
+            self.assertGreater(len([cmd for cmd in cmds if 'sys' in cmd]), 1)
+
+
+class CompactConfigTest(unittest.TestCase):
+
+    def check_round_trip(self, config):
+        original = copy.deepcopy(config.config)
+        result = CompactConfig.from_config(config).to_config().config
+        self.assertEqual(result, original)
+        # Check the types too, since 1 == 1.0
+        for group_id, group in original.items():
+            for key, val in group.items():
+                self.assertIs(type(result[group_id][key]), type(val),
+                              '%s%s' % (group_id, key))
+
+    def test_sample(self):
+        self.check_round_trip(load_sample())
+
+    def test_extras(self):
+        config = load_sample()
+        config.config['sys']['id'] = '3X3566-ZMX'
+        config.config['sys']['gpl'] = 1.0
+        config.config['sys']['new'] = 7
+        config.config['x']['vm'] = 2 ** 53 + 1
+        config.config['x']['fr'] = -2 ** 60
+        config.config['q'] = {'a' : 1, 'b' : 'two'}
+        self.check_round_trip(config)
+
+    def test_replace_extra(self):
+        compact = CompactConfig.from_config(make_config({'x' : {'vm' : 2 ** 60}}))
+        compact.add_group({'x' : {'vm' : 1000}})
+        self.assertEqual(compact.config, {'x' : {'vm' : 1000}})
+        compact.add_group({'x' : {'vm' : 'fast'}})
+        self.assertEqual(compact.config, {'x' : {'vm' : 'fast'}})
+
+
+class TextParserTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(SAMPLE_SHOW, 'r') as file:
+            self.text = file.read().replace('\n', '\r\n')
+        self.expected = Config()
+        self.expected.read_text(self.text.splitlines(True))
+        self.assertTrue(self.expected.config)
+
+    def check_chunks(self, chunks):
+        config = Config()
+        parser = TextParser(config)
+        items = []
+        for chunk in chunks:
+            items.extend(parser.feed(chunk))
+        items.extend(parser.close())
+        self.assertEqual(config.config, self.expected.config)
+        self.assertEqual(len(items), sum(len(group) for group in config.config.values()))
+
+    def test_small_chunks(self):
+        for size in (1, 2, 7, 64):
+            self.check_chunks([self.text[i:i + size]
+                               for i in range(0, len(self.text), size)])
+
+    def test_split_line_endings(self):
+        # Split between each '\r' and '\n'.
+        self.check_chunks(self.text.replace('\r\n', '\r|\n').split('|'))
+
+    def test_no_final_newline(self):
+        self.check_chunks([self.text.rstrip()])
+
+
+class ValidateTest(unittest.TestCase):
+
+    def test_parse_choices(self):
+        self.assertEqual(parse_choices('gpl', '{:d} [0=G17,1=G18,2=G19]'),
+                         frozenset((0, 1, 2)))
+        self.assertEqual(parse_choices('mi', '{:d} [1,2,4,8]'),
+                         frozenset((1, 2, 4, 8)))
+        self.assertEqual(parse_choices('gco', '{:d} [1-6 (G54-G59)]'), (1, 6))
+        self.assertEqual(parse_choices('cpl', '{:.3f} [0..1]'), (0.0, 1.0))
+        self.assertEqual(parse_choices('am', '{:d} [standard]'), (0, 3))
+        self.assertIsNone(parse_choices('ma', '{:d} [0=X,1=Y,2=Z...]'))
+        self.assertIsNone(parse_choices('vm', '{:d} mm/min'))
+
+    def test_sample_is_valid(self):
+        self.assertEqual(load_sample().validate(), ([], []))
+
+    def check_errors(self, group_dict, expected):
+        (errors, warnings) = make_config(group_dict).validate()
+        self.assertEqual([error[:2] for error in errors], expected)
+        self.assertEqual(warnings, [])
+
+    def test_enum_out_of_range(self):
+        self.check_errors({'sys' : {'gpl' : 3}}, [('sys', 'gpl')])
+        self.check_errors({'sys' : {'gpl' : 2}}, [])
+
+    def test_float_range(self):
+        self.check_errors({'p1' : {'cpl' : 1.5}}, [('p1', 'cpl')])
+        self.check_errors({'p1' : {'cpl' : -0.1}}, [('p1', 'cpl')])
+        self.check_errors({'p1' : {'cpl' : 1}}, [])
+
+    def test_axis_mode(self):
+        self.check_errors({'x' : {'am' : 4}, 'a' : {'am' : -1}},
+                          [('a', 'am'), ('x', 'am')])
+        self.check_errors({'x' : {'am' : 3}}, [])
+
+    def test_types(self):
+        self.check_errors({'sys' : {'ja' : 1.5, 'ct' : 'fast'}},
+                          [('sys', 'ct'), ('sys', 'ja')])
+        self.check_errors({'x' : {'vm' : True}}, [('x', 'vm')])
+
+    def test_unknown(self):
+        config = make_config({'x' : {'new' : 1}, 'q' : {}})
+        (errors, warnings) = config.validate()
+        self.assertEqual([error[:2] for error in errors], [('q', None), ('x', 'new')])
+        self.assertEqual(warnings, [])
+        # For restore, they're only warnings.
+        (errors, warnings) = config.validate(strict=False)
+        self.assertEqual(errors, [])
+        self.assertEqual([warning[:2] for warning in warnings], [('q', None), ('x', 'new')])
+
+    def test_read_only_is_warning(self):
+        (errors, warnings) = make_config({'sys' : {'baud' : 9}}).validate()
+        self.assertEqual(errors, [])
+        self.assertEqual([warning[:2] for warning in warnings], [('sys', 'baud')])
+
+    def test_group_not_dict(self):
+        self.check_errors({'sys' : 5}, [('sys', None)])
+
+    def lint(self, text):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'lint.config')
+        with open(filename, 'w') as file:
+            file.write(text)
+        (name, errors, warnings) = lint_file(filename)
+        self.assertEqual(name, filename)
+        return (errors, warnings)
+
+    def test_lint_file(self):
+        with open(SAMPLE_JSON, 'r') as file:
+            self.assertEqual(self.lint(file.read()), ([], []))
+        (errors, warnings) = self.lint('{"sys": {"gpl": 7, "baud": 0}}')
+        self.assertEqual(len(errors), 1)
+        self.assertIn('gpl', errors[0])
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('baud', warnings[0])
+
+    def test_lint_file_not_dict(self):
+        for text in ('[1, 2]\n', '{"sys": 5}\n', '{"sys": \n'):
+            (errors, warnings) = self.lint(text)
+            self.assertEqual(len(errors), 1, text)
+
+
+class LateResponseTest(unittest.TestCase):
+    """A response which arrives after its command timed out mustn't be
+       mistaken for the response to a later command.
+    """
+
+    def check_read(self, pipeline):
+        sample = load_sample()
+        tinyg = open_tinyg(self, LateSimBus(load_sample(), '{"r":{"2":'),
+                           pipeline=pipeline)
+        config = Config()
+        tinyg.read_config(config)
+        for mapEntry in CONFIG_MAP:
+            self.assertEqual(config.get_group(mapEntry[0]),
+                             sample.get_group(mapEntry[0]), mapEntry[0])
+        # Give any late responses time to arrive.
+        time.sleep(LATE_DELAY)
+        self.assertEqual(tinyg.read_group('sys'), sample.get_group('sys'))
+
+    def test_read_config(self):
+        self.check_read(pipeline=False)
+
+    def test_read_config_pipelined(self):
+        self.check_read(pipeline=True)
+
+    def test_read_config_pipelined_late(self):
+        # The late response arrives while the read is still going, after
+        # the query has been resent.
+        sample = load_sample()
+        stats = Stats()
+        tinyg = open_tinyg(self, LateSimBus(load_sample(), '{"r":{"x":', delay=0.1),
+                           pipeline=True, stats=stats)
+        config = Config()
+        tinyg.read_config(config)
+        self.assertEqual(config.config, sample.config)
+        # Only the query for x should have been resent.
+        self.assertEqual(stats.retries, 1)
+
+    def test_write_config(self):
+        config = load_sample()
+        config.add_group({'x' : {'vm' : 12345}, 'g30' : {'x' : 7.5}})
+        board = Config()
+        board.add_group({'sys' : load_sample().get_group('sys')})
+        tinyg = open_tinyg(self, LateSimBus(board, '{"r":{"1":'))
+        tinyg.write_config(config)
+        self.assertEqual(tinyg.verify_config(config), [])
+        self.assertEqual(board.get_group('x')['vm'], 12345)
+        self.assertEqual(board.get_group('g30')['x'], 7.5)
+
+    def test_write_config_checkpoint(self):
+        # Each command is only recorded in the checkpoint once the board
+        # has acknowledged that command (not a late ack for another).
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        checkpoint = RestoreCheckpoint(os.path.join(directory, 'restore.checkpoint'))
+        acks = []
+        ack = checkpoint.ack
+        def record_ack(index):
+            acks.append(index)
+            ack(index)
+        checkpoint.ack = record_ack
+        config = load_sample()
+        board = Config()
+        board.add_group({'sys' : load_sample().get_group('sys')})
+        tinyg = open_tinyg(self, LateSimBus(board, '{"r":{"x":'))
+        tinyg.write_config(config, checkpoint)
+        self.assertEqual(acks, list(range(len(pack_commands(config)))))
+        self.assertFalse(os.path.exists(checkpoint.filename))
+        self.assertEqual(tinyg.verify_config(config), [])
+
+    def test_write_config_unwritable_checkpoint(self):
+        # A checkpoint which can't be written doesn't stop the restore.
+        checkpoint = RestoreCheckpoint(os.path.join(os.devnull, 'restore.checkpoint'))
+        config = load_sample()
+        tinyg = open_tinyg(self, SimBus(Config()))
+        tinyg.write_config(config, checkpoint)
+        self.assertEqual(tinyg.verify_config(config), [])
+
+    def test_write_config_diff_verifies_written_items(self):
+        config = load_sample()
+        config.add_group({'x' : {'vm' : 12345}})
+        tinyg = open_tinyg(self, LateSimBus(load_sample(), '{"r":{"y":'))
+        (changed, same, failed) = tinyg.write_config_diff(config)
+        self.assertEqual(changed.config, {'x' : {'vm' : 12345}})
+        self.assertEqual(failed, [])
+        self.assertEqual(tinyg.verify_config(changed), [])
+
+
+class FailureTest(unittest.TestCase):
+    """Groups which can't be read or written are reported to the caller."""
+
+    def test_read_config(self):
+        for pipeline in (False, True):
+            tinyg = open_tinyg(self, DeafSimBus(load_sample(), '{"g55":'),
+                               pipeline=pipeline)
+            config = Config()
+            self.assertEqual(tinyg.read_config(config), ['g55'])
+            self.assertIsNone(config.get_group('g55'))
+
+    def test_write_config(self):
+        tinyg = open_tinyg(self, DeafSimBus(load_sample(), '{"p1":'))
+        self.assertEqual(tinyg.write_config(load_sample()), ['p1'])
+        # p1 can't be read either, so a differential restore writes it.
+        (changed, same, failed) = tinyg.write_config_diff(load_sample())
+        self.assertEqual(failed, ['p1'])
+        self.assertEqual(list(changed.config), ['p1'])
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_stream_is_counted(self):
+        stats = Stats()
+        tinyg = open_tinyg(self, SimBus(load_sample()), stats=stats)
+        lines_sent = stats.lines_sent
+        bytes_sent = stats.bytes_sent
+        GcodeStreamer(tinyg).stream(['G0 X1', 'G0 X2', 'G0 X0'])
+        self.assertEqual(stats.lines_sent - lines_sent, 3)
+        self.assertEqual(stats.bytes_sent - bytes_sent, 18)
+
+
+class StreamTest(unittest.TestCase):
+
+    def test_rejected_lines_are_counted(self):
+        class RejectingSimBus(SimBus):
+            def gcode_status(self, line):
+                return 108 if 'Q' in line else SimBus.gcode_status(self, line)
+        tinyg = open_tinyg(self, RejectingSimBus(load_sample()))
+        streamer = GcodeStreamer(tinyg)
+        streamer.stream(['G0 X1', 'G0 Q2', 'G0 X0'])
+        self.assertEqual(streamer.lines_sent, 3)
+        self.assertEqual(streamer.errors, 1)
+
+
+class DaemonTest(unittest.TestCase):
+
+    def test_restore_verifies(self):
+        tinyg = open_tinyg(self, SimBus(load_sample()))
+        daemon = ConfigDaemon(tinyg)
+        config = load_sample()
+        config.add_group({'x' : {'vm' : 12345}})
+        response = daemon.handle_request({'cmd' : 'restore',
+                                          'config' : config.config,
+                                          'diff' : True, 'verify' : True})
+        self.assertEqual(response['mismatches'], [])
+        self.assertEqual(daemon.config.get_group('x')['vm'], 12345)
+
+    def test_partial_read_is_not_served(self):
+        bus = DeafSimBus(load_sample(), '{"g55":')
+        daemon = ConfigDaemon(open_tinyg(self, bus))
+        self.assertRaises(TinyGTimeout, daemon.handle_request, {'cmd' : 'show'})
+        self.assertIsNone(daemon.config)
+        # Once the board answers again, it's read again.
+        bus.prefix = 'nothing'
+        response = daemon.handle_request({'cmd' : 'show'})
+        self.assertEqual(response['config'], load_sample().config)
+
+    def test_restore_invalidates_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = ConfigCache(cache_dir)
+        cache.store(load_sample())
+        sys_group = load_sample().get_group('sys')
+        self.assertIsNotNone(cache.lookup(sys_group))
+        tinyg = open_tinyg(self, SimBus(load_sample()))
+        daemon = ConfigDaemon(tinyg, cache)
+        daemon.handle_request({'cmd' : 'restore',
+                               'config' : {'x' : {'vm' : 12345}}})
+        self.assertIsNone(cache.lookup(sys_group))
+
+
+if __name__ == '__main__':
+    unittest.main()